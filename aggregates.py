@@ -0,0 +1,61 @@
+class Aggregate():
+    """
+    Base class for sql aggregate functions used by Queryset.aggregate() and
+    Queryset.annotate(), eg. Sum('count') or Count('user_id', distinct=True)
+    """
+
+    function = None
+    # used by Queryset.to_columns() for annotated columns
+    numpy_dtype = 'object'
+    nullable = True
+
+    def __init__(self, column, distinct=False):
+        self.column = column
+        self.distinct = distinct
+
+    def __eq__(self, other):
+        return type(self) is type(other) and (self.column, self.distinct) == (other.column, other.distinct)
+
+    def __hash__(self):
+        return hash((type(self), self.column, self.distinct))
+
+    def __repr__(self):
+        distinct = ', distinct=True' if self.distinct else ''
+        return f"{self.__class__.__name__}({self.column!r}{distinct})"
+
+    def as_sql(self):
+        distinct = 'DISTINCT ' if self.distinct else ''
+        return f"{self.function}({distinct}{self.column})"
+
+
+class Avg(Aggregate):
+    """ average, as a float (postgres returns numeric for integer columns) """
+
+    function = 'AVG'
+    numpy_dtype = 'float64'
+
+    def as_sql(self):
+        return f"{super().as_sql()}::double precision"
+
+
+class Count(Aggregate):
+    """ number of non NULL values, Count('*') counts rows """
+
+    function = 'COUNT'
+    numpy_dtype = 'int64'
+    nullable = False
+
+
+class Max(Aggregate):
+    function = 'MAX'
+
+
+class Min(Aggregate):
+    function = 'MIN'
+
+
+class Sum(Aggregate):
+    """ sum of the values, None when there are no rows """
+
+    function = 'SUM'
+    numpy_dtype = 'float64'
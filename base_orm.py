@@ -1,114 +1,419 @@
-from collections import OrderedDict
-import inspect
+from collections import namedtuple
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from types import MappingProxyType, MemberDescriptorType
 
 import psycopg2
 
+from copy_streams import CopyInStream, iter_copy_lines
 from exceptions import DeletionFailed, ModelNotFound, MultipleObjectsReturned
 from fields import BaseField, ForeignKey
+from indexes import Index
+from pool import AsyncConnectionPool, ConnectionPool, async_connect, check_connection, ping_connection
+from query import Query
 from querysets import FlatValuesListIterable, ModelIterable, Queryset, ValuesIterable, ValuesListIterable
+from sessions import current_session
 from settings import DB_SETTINGS
+from statements import PreparedStatementCache, statement_cache
+from transactions import Atomic, current_transaction
 
 
 class BaseManager:
 
-    connection = None
+    pool = None
+    async_pool = None
+    prepared_statements = None
+    result_cache = None
 
     @classmethod
     def set_connection(cls, db_settings):
-        connection = psycopg2.connect(
+        connect = partial(
+            psycopg2.connect,
             dbname=db_settings.get('DB_NAME'),
             user=db_settings.get('DB_USER'),
             password=db_settings.get('DB_PASS'),
             host=db_settings.get('DB_HOST')
         )
-        cls.connection = connection
+        pool = ConnectionPool(
+            connect,
+            min_size=db_settings.get('POOL_MIN_SIZE', 1),
+            max_size=db_settings.get('POOL_MAX_SIZE', 10),
+            timeout=db_settings.get('POOL_TIMEOUT', 30.0),
+            max_lifetime=db_settings.get('POOL_MAX_LIFETIME', 3600.0),
+            health_check=ping_connection if db_settings.get('POOL_PING') else check_connection
+        )
+        async_pool = AsyncConnectionPool(
+            partial(
+                async_connect,
+                dbname=db_settings.get('DB_NAME'),
+                user=db_settings.get('DB_USER'),
+                password=db_settings.get('DB_PASS'),
+                host=db_settings.get('DB_HOST')
+            ),
+            max_size=db_settings.get('POOL_MAX_SIZE', 10),
+            timeout=db_settings.get('POOL_TIMEOUT', 30.0),
+            max_lifetime=db_settings.get('POOL_MAX_LIFETIME', 3600.0)
+        )
+        cls.set_async_pool(async_pool)
+        prepared = None
+        if db_settings.get('PREPARED_STATEMENTS'):
+            prepared = PreparedStatementCache(
+                maxsize=db_settings.get('PREPARED_MAXSIZE', 100),
+                threshold=db_settings.get('PREPARE_THRESHOLD', 5)
+            )
+        cls.set_prepared_statements(prepared)
+        return cls.set_pool(pool)
+
+    @classmethod
+    def set_pool(cls, pool):
+        """ any object with getconn/putconn/connection/stats may be used as pool """
+        if cls.pool is not None:
+            cls.pool.closeall()
+        cls.pool = pool
+        return cls
+
+    @classmethod
+    def set_async_pool(cls, pool):
+        """ pool used by the a* methods, connections are only opened once they are awaited """
+        cls.async_pool = pool
+        return cls
+
+    @classmethod
+    @contextmanager
+    def _connection(cls):
+        """
+        connection for the duration of a with block: the atomic block's connection
+        when inside one, otherwise one borrowed from the pool
+        """
+        transaction = current_transaction()
+        if transaction is not None:
+            yield transaction.connection
+            return
+        with cls.pool.connection() as connection:
+            yield connection
+
+    @classmethod
+    def set_prepared_statements(cls, cache):
+        """ opt in to server side prepared statements with a PreparedStatementCache, None turns them off """
+        cls.prepared_statements = cache
         return cls
 
     @classmethod
-    def _commit(cls):
-        cls.connection.commit()
+    def set_result_cache(cls, cache):
+        """ cache query results in a ResultCache, None turns caching off """
+        cls.result_cache = cache
+        return cls
 
     @classmethod
-    def _get_cursor(cls):
-        return cls.connection.cursor()
+    def _cache_key(cls, model, tables, sql, params):
+        """ result cache key for a read, None when it should not be cached (eg. inside an atomic block) """
+        cache = cls.result_cache
+        if cache is None or current_transaction() is not None or cache.ttl_for(model) == 0:
+            return None
+        return cache.key(tables, sql, params)
 
     @classmethod
-    def _execute_query(cls, query, params=None):
-        cursor = cls._get_cursor()
-        cursor.execute(query, params)
+    def _invalidate_tables(cls, tables):
+        if cls.result_cache is not None and tables:
+            cls.result_cache.invalidate(*sorted(tables))
+
+    @classmethod
+    def _invalidate(cls, model, delete=False):
+        """
+        drop cached results for model's table after a write. deletes also change the
+        tables referencing it through on_delete CASCADE / SET NULL
+        """
+        if cls.result_cache is None:
+            return
+        tables = set()
+        pending = [model]
+        while pending:
+            current = pending.pop()
+            if current._meta.table_name in tables:
+                continue
+            tables.add(current._meta.table_name)
+            if delete:
+                pending.extend(rel_model for rel_model, _ in current._meta.reverse_relations.values())
+        transaction = current_transaction()
+        if transaction is not None:
+            transaction.written_tables.update(tables)
+        cls._invalidate_tables(tables)
+
+    @classmethod
+    def _execute(cls, cursor, sql, params=None):
+        if cls.prepared_statements is None:
+            cursor.execute(sql, params)
+        else:
+            cls.prepared_statements.execute(cursor, sql, params)
+
+    @classmethod
+    @asynccontextmanager
+    async def _aconnection(cls):
+        """ asyncio connection borrowed from the async pool for the duration of an async with block """
+        async with cls.async_pool.connection() as connection:
+            yield connection
+
+    @classmethod
+    def _commit(cls, connection):
+        """ commit unless an atomic block is deferring commits to its end """
+        if current_transaction() is None:
+            connection.commit()
 
     def __init__(self, model):
         self.model = model
 
     def all(self):
-        cursor = self._get_cursor()
-        sql, cols = self.model._get_select_all_sql()
-        return Queryset(ModelIterable, self.model, cursor, sql, cols)
+        return Queryset(ModelIterable, self.model, Query(self.model))
+
+    def bulk_create(self, instances, batch_size=1000):
+        """
+        insert instances with multi row INSERT statements of at most batch_size rows,
+        committing once and setting the new id on each instance
+        """
+        instances = list(instances)
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            for start in range(0, len(instances), batch_size):
+                batch = instances[start:start + batch_size]
+                sql, cols = self.model._get_bulk_insert_sql(len(batch))
+                params = [getattr(instance, col) for instance in batch for col in cols]
+                self._execute(cursor, sql, params)
+                for instance, res in zip(batch, cursor.fetchall()):
+                    instance.id = res[0]
+            self._commit(connection)
+        self._invalidate(self.model)
+        for instance in instances:
+            instance._snapshot()
+        session = current_session()
+        if session is not None:
+            for instance in instances:
+                session.add(instance)
+        return instances
+
+    def copy_in(self, rows):
+        """
+        stream model instances or dicts into the table with COPY ... FROM STDIN,
+        rows are encoded lazily so memory does not grow with input size
+        """
+        sql = self.model._get_copy_in_sql()
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            cursor.copy_expert(sql, CopyInStream(iter_copy_lines(self.model, rows)))
+            self._commit(connection)
+        self._invalidate(self.model)
+        return cursor.rowcount
 
     def create(self, **kwargs):
-        cursor = self._get_cursor()
         sql, fields, params = self.model._get_create_sql(**kwargs)
-        # print(sql, fields, params)
-        cursor.execute(sql, params)
-        res = cursor.fetchone()
-        new_id = res[0]
-        self._commit()
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, sql, params)
+            res = cursor.fetchone()
+            new_id = res[0]
+            self._commit(connection)
+        self._invalidate(self.model)
 
         return self.get(id=new_id)
 
+    async def acreate(self, **kwargs):
+        sql, fields, params = self.model._get_create_sql(**kwargs)
+        async with self._aconnection() as connection:
+            cursor = await connection.execute(sql, params)
+            res = await cursor.fetchone()
+            await connection.commit()
+        self._invalidate(self.model)
+
+        return await self.aget(id=res[0])
+
     def create_table(self):
-        cursor = self._get_cursor()
+        """ create the table if it does not exist, along with its indexes """
         sql = self.model._create_table_sql()
-        cursor.execute(sql)
-        self._commit()
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(sql)
+            for index_sql in self.model._create_index_sql():
+                cursor.execute(index_sql)
+            self._commit(connection)
+        if self.prepared_statements is not None:
+            self.prepared_statements.invalidate()
+        self._invalidate(self.model)
+
+    def create_indexes(self, concurrently=True):
+        """
+        create the model's missing indexes on an existing table. CONCURRENTLY builds
+        them without locking out writes, but can not run inside an atomic block
+        """
+        if concurrently and current_transaction() is not None:
+            raise ValueError('create_indexes(concurrently=True) can not run inside an atomic block')
+        statements = self.model._create_index_sql(concurrently)
+        with self._connection() as connection:
+            if not concurrently:
+                cursor = connection.cursor()
+                for sql in statements:
+                    cursor.execute(sql)
+                self._commit(connection)
+                return statements
+            connection.autocommit = True
+            try:
+                cursor = connection.cursor()
+                for sql in statements:
+                    cursor.execute(sql)
+            finally:
+                connection.autocommit = False
+        return statements
 
     def delete(self, instance):
-        cursor = self._get_cursor()
         sql, params = instance._get_delete_sql()
-        cursor.execute(sql, params)
-        self._commit()
-
-    def get(self, **kwargs):
-        cursor = self._get_cursor()
-        sql, fields, params = self.model._get_single_row_sql(**kwargs)
-        cursor.execute(sql, params)
-        res = cursor.fetchall()
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, sql, params)
+            self._commit(connection)
+        self._invalidate(self.model, delete=True)
+        session = current_session()
+        if session is not None:
+            session.discard(instance)
+
+    def _check_rows(self, res):
         num_rows = len(res)
-
         if num_rows > 1:
             raise MultipleObjectsReturned(f"Call to model manager expected 1 object, call returned {num_rows}!")
         elif not num_rows:
             raise ModelNotFound('No objects returned from query')
+        return res[0]
+
+    def _get_row(self, **kwargs):
+        """ fetch exactly one row, returns the selected columns and the row """
+        sql, fields, params = self.model._get_single_row_sql(**kwargs)
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, sql, params)
+            res = cursor.fetchall()
+        return fields, self._check_rows(res)
 
-        instance = self.model()
-        for field, val in zip(fields, res[0]):
+    async def _aget_row(self, **kwargs):
+        sql, fields, params = self.model._get_single_row_sql(**kwargs)
+        async with self._aconnection() as connection:
+            cursor = await connection.execute(sql, params)
+            res = await cursor.fetchall()
+        return fields, self._check_rows(res)
+
+    def _cached(self, session, **kwargs):
+        """ instance held by the session for a get(id=...) call, if any """
+        if session is not None and list(kwargs) == ['id']:
+            return session.get(self.model, kwargs['id'])
+        return None
+
+    def _from_row(self, session, fields, row):
+        if session is not None:
+            instance = session.get(self.model, row[fields.index('id')])
+            if instance is not None:
+                return instance
+
+        instance = self.model.from_db(fields, row)
+        if session is not None:
+            session.add(instance)
+        return instance
+
+    def get(self, **kwargs):
+        session = current_session()
+        instance = self._cached(session, **kwargs)
+        if instance is not None:
+            return instance
+        fields, row = self._get_row(**kwargs)
+        return self._from_row(session, fields, row)
+
+    async def aget(self, **kwargs):
+        session = current_session()
+        instance = self._cached(session, **kwargs)
+        if instance is not None:
+            return instance
+        fields, row = await self._aget_row(**kwargs)
+        return self._from_row(session, fields, row)
+
+    def refresh(self, instance):
+        """ reload instance values from the database """
+        fields, row = self._get_row(id=instance.id)
+        for field, val in zip(fields, row):
             setattr(instance, field, val)
+        instance._loaded = (fields, row)
         return instance
 
     def save(self, instance):
-        cursor = self._get_cursor()
         sql, vals = instance._get_insert_sql()
-        cursor.execute(sql, vals)
-        res = cursor.fetchone()
-        instance._state['id'] = res[0]
-        self._commit()
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            self._execute(cursor, sql, vals)
+            res = cursor.fetchone()
+            instance.id = res[0]
+            self._commit(connection)
+        self._invalidate(self.model)
+        instance._snapshot()
+        session = current_session()
+        if session is not None:
+            session.add(instance)
         return instance
 
+    def stats(self):
+        """ connection pool statistics """
+        return self.pool.stats()
+
     def values(self, *args):
-        cursor = self._get_cursor()
-        sql, cols = self.model._get_values_sql(*args)
-        return Queryset(ValuesIterable, self.model, cursor, sql, list(cols))
+        return Queryset(ValuesIterable, self.model, Query(self.model, args))
 
     def values_list(self, *args, **kwargs):
-        cursor = self._get_cursor()
-        sql, cols = self.model._get_values_sql(*args)
         iterable = FlatValuesListIterable if kwargs.get('flat') else ValuesListIterable
-        return Queryset(iterable, self.model, cursor, sql, list(cols))
+        return Queryset(iterable, self.model, Query(self.model, args))
 
     def where(self, **kwargs):
-        cursor = self._get_cursor()
-        sql, cols, params = self.model._get_filter_sql(**kwargs)
-        return Queryset(ModelIterable, self.model, cursor, sql, cols, params=params)
+        return self.all().where(**kwargs)
+
+
+def _set_attribute(instance, value, name):
+    setattr(instance, name, value)
+
+
+Column = namedtuple('Column', ['name', 'column', 'field'])
+
+
+class Options():
+    """
+    Column metadata for a model, built once by MetaModel at class creation
+    """
+
+    def __init__(self, model_name, fields, indexes=()):
+        self.table_name = "{name}s_{name}".format(name=model_name.lower())
+        self.fields = tuple(
+            Column(name, f"{name}_id" if isinstance(field, ForeignKey) else name, field)
+            for name, field in sorted(fields.items())
+        )
+        self.columns = tuple(col.column for col in self.fields)
+        self.all_columns = self.columns if 'id' in self.columns else ('id',) + self.columns
+        self.fk_columns = tuple(col.column for col in self.fields if isinstance(col.field, ForeignKey))
+        self.relations = MappingProxyType({col.name: col for col in self.fields if isinstance(col.field, ForeignKey)})
+        # filled in as models with foreign keys to this one are created
+        self.reverse_relations = {}
+        # columns tuple -> attribute setters, filled in by Model.from_db
+        self.row_setters = {}
+        self.defaults = MappingProxyType({col.column: col.field.default for col in self.fields})
+        self.column_definitions = tuple(
+            col.field.get_fk_text(col.name) if isinstance(col.field, ForeignKey)
+            else f'{col.name} {col.field.get_sql_text}'
+            for col in self.fields
+        )
+        self.indexes = self._build_indexes(indexes)
+
+    def _build_indexes(self, declared):
+        """ indexes from field index=True / unique=True (foreign keys by default) and Meta.indexes """
+        indexes = [
+            Index(col.column, unique=col.field.unique)
+            for col in self.fields if col.field.index or col.field.unique
+        ]
+        for index in declared:
+            unknown = [column for column in index.columns if column.lstrip('-') not in self.all_columns]
+            if unknown:
+                raise ValueError(f"Unknown index columns for {self.table_name}: {', '.join(unknown)}")
+            indexes.append(index)
+        return tuple(dict.fromkeys(indexes))
 
 
 class MetaModel(type):
@@ -116,6 +421,38 @@ class MetaModel(type):
 
     manager_class = BaseManager.set_connection(DB_SETTINGS)
 
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in reversed(bases):
+            if isinstance(base, MetaModel):
+                fields.update((col.name, col.field) for col in base._meta.fields)
+        for attr, value in attrs.items():
+            if isinstance(value, BaseField):
+                fields[attr] = value
+            elif attr in fields:
+                del fields[attr]
+        meta_options = attrs.get('Meta')
+        meta = Options(name, fields, getattr(meta_options, 'indexes', ()))
+
+        # fields become slots, so instances have no per instance dicts and
+        # attribute access goes through C level member descriptors
+        inherited = set()
+        for base in bases:
+            for klass in base.__mro__:
+                inherited.update(vars(klass).get('__slots__', ()))
+        slots = [slot for slot in ('id', '_loaded') + meta.columns + tuple(meta.relations) if slot not in inherited]
+        if '__dict__' not in inherited:
+            # keeps arbitrary attributes (eg. prefetched reverse relations) working
+            slots.insert(0, '__dict__')
+        attrs = {attr: value for attr, value in attrs.items() if not isinstance(value, BaseField) and attr != 'Meta'}
+        attrs['__slots__'] = tuple(slots)
+
+        cls = super().__new__(mcs, name, bases, attrs)
+        cls._meta = meta
+        for col in meta.relations.values():
+            col.field.model._meta.reverse_relations[f"{name.lower()}_set"] = (cls, col)
+        return cls
+
     def _get_manager(cls):
         return cls.manager_class(model=cls)
 
@@ -123,215 +460,169 @@ class MetaModel(type):
     def objects(cls):
         return cls._get_manager()
 
-    @property
-    def _db(cls):
-        return cls.manager_class.connection
+
+def atomic():
+    """
+    with atomic(): ... runs the block in one transaction, committed at the end of
+    the outermost block and rolled back on exception. Blocks nest using savepoints
+    """
+    return Atomic(MetaModel.manager_class)
 
 
 class Model(metaclass=MetaModel):
     """ Base Model Class """
     def __init__(self, **kwargs):
-        self._state = {
-            "id": None
-        }
+        self.id = None
+        self._loaded = None
+        relations = self._meta.relations
+        for name, column, _ in self._meta.fields:
+            # prevent foreign key overwrites
+            if column in kwargs:
+                continue
+            if name in relations and name in kwargs:
+                related = kwargs[name]
+                setattr(self, column, related.id if related is not None else None)
+            else:
+                setattr(self, column, self._meta.defaults[column])
+
         for key, value in kwargs.items():
-            self._state[key] = value
+            setattr(self, key, value)
 
-        # set defaults
-        for name, column_type in inspect.getmembers(type(self)):
-            # prevent foreign key overwrites
-            if isinstance(column_type, BaseField) and name not in self._state and f"{name}_id" not in self._state:
-                if isinstance(column_type, ForeignKey):
-                    if '_id' not in name:
-                        name = f"{name}_id"
-                val = getattr(column_type, 'default')
-                self._state[name] = val
-
-    def __getattribute__(self, key):
-        # prevent recursion
-        _state = super().__getattribute__("_state")
-        if key in _state:
-            return _state[key]
-        return super().__getattribute__(key)
-
-    def __setattr__(self, name, value):
-        super().__setattr__(name, value)
-        if name in self._state:
-            self._state[name] = value
+    @classmethod
+    def from_db(cls, columns, row):
+        """
+        build an instance straight from a database row (columns must be a tuple),
+        skipping __init__ and default values
+        """
+        setters = cls._meta.row_setters.get(columns)
+        if setters is None:
+            setters = cls._meta.row_setters[columns] = cls._get_row_setters(columns)
+        instance = cls.__new__(cls)
+        for setter, value in zip(setters, row):
+            setter(instance, value)
+        instance._loaded = (columns, row)
+        return instance
 
     # helper methods
 
+    def _snapshot(self):
+        """ remember current values as the saved state used for dirty tracking """
+        columns = self._meta.all_columns
+        self._loaded = (columns, tuple(getattr(self, column, None) for column in columns))
+
     @classmethod
-    def _get_create_sql(cls, **kwargs):
-        sql = "INSERT INTO {table_name}s_{table_name} ({column_names}) VALUES ({placeholders}) RETURNING id;"
-        table_name = cls.__name__.lower()
-        cols = []
-        placeholders = []
-        values = []
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    if '_id' not in name:
-                        name = f"{name}_id"
-                    cols.append(name)
-                else:
-                    cols.append(name)
-                placeholders.append('%s')
-                # append instances default value if name not present
-                values.append(kwargs.get(name, getattr(column_type, 'default')))
+    def _get_row_setters(cls, columns):
+        """ slot descriptor __set__ per column, setattr for anything that is not a slot """
+        setters = []
+        for column in columns:
+            descriptor = getattr(cls, column, None)
+            if isinstance(descriptor, MemberDescriptorType):
+                setters.append(descriptor.__set__)
+            else:
+                setters.append(partial(_set_attribute, name=column))
+        return tuple(setters)
+
+    @classmethod
+    def _compile_insert_sql(cls):
+        sql = "INSERT INTO {table_name} ({column_names}) VALUES ({placeholders}) RETURNING id;"
+        cols = cls._meta.columns
+        final_sql = sql.format(
+            table_name=cls._meta.table_name,
+            column_names=", ".join(cols),
+            placeholders=", ".join(['%s'] * len(cols))
+        )
+        return final_sql, cols
 
+    @classmethod
+    def _compile_bulk_insert_sql(cls, num_rows):
+        sql = "INSERT INTO {table_name} ({column_names}) VALUES {rows} RETURNING id;"
+        cols = cls._meta.columns
+        row = "({placeholders})".format(placeholders=", ".join(['%s'] * len(cols)))
         final_sql = sql.format(
-            table_name=table_name,
+            table_name=cls._meta.table_name,
             column_names=", ".join(cols),
-            placeholders=", ".join(placeholders)
+            rows=", ".join([row] * num_rows)
         )
-        return final_sql, cols, values
+        return final_sql, cols
+
+    @classmethod
+    def _compile_update_sql(cls, cols):
+        sql = "UPDATE {table_name} SET {fields} WHERE id = %s"
+        final_sql = sql.format(
+            table_name=cls._meta.table_name,
+            fields=", ".join([f"{col} = %s" for col in cols])
+        )
+        return final_sql, cols
+
+    @classmethod
+    def _get_bulk_insert_sql(cls, num_rows):
+        return statement_cache.get_or_compile(
+            (cls, 'bulk_insert', num_rows),
+            lambda: cls._compile_bulk_insert_sql(num_rows)
+        )
+
+    @classmethod
+    def _get_copy_in_sql(cls):
+        sql = "COPY {table_name} ({column_names}) FROM STDIN;"
+        return sql.format(table_name=cls._meta.table_name, column_names=", ".join(cls._meta.columns))
+
+    @classmethod
+    def _get_create_sql(cls, **kwargs):
+        final_sql, cols = statement_cache.get_or_compile((cls, 'insert'), cls._compile_insert_sql)
+        # append instances default value if name not present
+        values = [kwargs.get(col, cls._meta.defaults[col]) for col in cols]
+        return final_sql, list(cols), values
 
     @classmethod
     def _create_table_sql(cls):
-        sql = "CREATE TABLE IF NOT EXISTS {table_name}s_{table_name} ({columns});"
-        table_name = cls.__name__.lower()
+        sql = "CREATE TABLE IF NOT EXISTS {table_name} ({columns});"
         columns = ['id SERIAL PRIMARY KEY']
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    columns.append(f'{column_type.get_fk_text(name)}')
-                else:
-                    columns.append(f'{name} {column_type.get_sql_text}')
+        columns.extend(cls._meta.column_definitions)
         final_sql = sql.format(
-            table_name=table_name,
+            table_name=cls._meta.table_name,
             columns=", ".join(columns))
         return final_sql
 
+    @classmethod
+    def _create_index_sql(cls, concurrently=False):
+        return [index.create_sql(cls._meta.table_name, concurrently) for index in cls._meta.indexes]
+
     def _get_delete_sql(self):
-        sql = "DELETE from {table_name}s_{table_name} WHERE id = %s"
-        cls = self.__class__
+        sql = "DELETE from {table_name} WHERE id = %s"
         values = [getattr(self, 'id')]
-        final_sql = sql.format(table_name=cls.__name__.lower())
+        final_sql = sql.format(table_name=self._meta.table_name)
         return final_sql, values
 
     @classmethod
     def _get_filter_sql(cls, **kwargs):
-        sql = """
-        SELECT {fields} FROM {table_name}s_{table_name}
-        WHERE {criteria};
-        """
-        table_name = cls.__name__.lower()
-
-        fields = []
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    fields.append(f'{name}_id')
-                else:
-                    fields.append(name)
-
-        if 'id' not in fields:
-            fields.insert(0, 'id')
-
-        cols = OrderedDict(**kwargs)
-        criteria = [name for name in cols.keys()]
-        values = [val for val in cols.values()]
-
-        final_sql = sql.format(
-            fields=", ".join(fields),
-            table_name=table_name,
-            criteria=f"{'=%s AND '.join(criteria)}=%s"
-        )
-
-        return final_sql, fields, values
+        query = Query(cls)
+        query.add_filter(**kwargs)
+        final_sql, values = query.compile()
+        return final_sql, query.columns, values
 
     def _get_insert_sql(self):
-        sql = "INSERT INTO {table_name}s_{table_name} ({column_names}) VALUES ({placeholders}) RETURNING id;"
-        cls = self.__class__
-        cols = []
-        values = []
-        placeholders = []
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    cols.append(f'{name}_id')
-                    values.append(getattr(self, f"{name}_id"))
-                else:
-                    cols.append(name)
-                    values.append(getattr(self, name))
-                placeholders.append('%s')
-
-        final_sql = sql.format(
-            table_name=cls.__name__.lower(),
-            column_names=", ".join(cols),
-            placeholders=", ".join(placeholders)
-        )
+        final_sql, cols = statement_cache.get_or_compile((type(self), 'insert'), self._compile_insert_sql)
+        values = [getattr(self, col) for col in cols]
         return final_sql, values
 
     @classmethod
     def _get_select_all_sql(cls):
-        sql = "SELECT {columns} FROM {table_name}s_{table_name};"
-        table_name = cls.__name__.lower()
-        cols = ['id']
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    name = f"{name}_id"
-                cols.append(name)
-
-        final_sql = sql.format(columns=", ".join(cols), table_name=table_name)
-        return final_sql, cols
+        query = Query(cls)
+        final_sql, _ = query.compile()
+        return final_sql, list(query.columns)
 
     @classmethod
     def _get_single_row_sql(cls, **kwargs):
-        sql = """
-        SELECT {fields} FROM {table_name}s_{table_name}
-        WHERE {criteria};
-        """
-        table_name = cls.__name__.lower()
-        fields = []
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    fields.append(f'{name}_id')
-                else:
-                    fields.append(name)
-
-        if 'id' not in fields:
-            fields.insert(0, 'id')
-        cols = OrderedDict(**kwargs)
-        criteria = [name for name in cols.keys()]
-        values = [val for val in cols.values()]
-        final_sql = sql.format(
-            fields=", ".join(fields),
-            table_name=table_name,
-            criteria=f"{'=%s AND '.join(criteria)}=%s"
-        )
-
-        return final_sql, fields, values
+        return cls._get_filter_sql(**kwargs)
 
-    @classmethod
-    def _get_values_sql(cls, *args):
-        sql = "SELECT {columns} FROM {table_name}s_{table_name};"
-        table_name = cls.__name__.lower()
-        final_sql = sql.format(columns=", ".join(args), table_name=table_name)
-        return final_sql, args
-
-    def _get_update_sql(self):
-        sql = "UPDATE {table_name}s_{table_name} SET {fields} WHERE id = %s"
-        cls = self.__class__
-        cols = []
-        values = []
-        for name, column_type in inspect.getmembers(cls):
-            if isinstance(column_type, BaseField):
-                if isinstance(column_type, ForeignKey):
-                    name = f"{name}_id"
-                cols.append(name)
-                values.append(getattr(self, name))
-
-        values.append(getattr(self, 'id'))
-
-        final_sql = sql.format(
-            table_name=cls.__name__.lower(),
-            fields=", ".join([f"{col} = %s" for col in cols])
+    def _get_update_sql(self, cols=None):
+        cols = self._meta.columns if cols is None else tuple(cols)
+        final_sql, cols = statement_cache.get_or_compile(
+            (type(self), 'update', cols),
+            lambda: self._compile_update_sql(cols)
         )
-
+        values = [getattr(self, col) for col in cols]
+        values.append(getattr(self, 'id'))
         return final_sql, values
 
     # public methods
@@ -340,28 +631,103 @@ class Model(metaclass=MetaModel):
         """Delete instance in db"""
         try:
             cls = type(self)
-            db = cls._db
-            cursor = db.cursor()
-            sql, params = self._get_delete_sql()
-            cursor.execute(sql, params)
-            db.commit()
+            with cls.manager_class._connection() as db:
+                cursor = db.cursor()
+                sql, params = self._get_delete_sql()
+                cls.manager_class._execute(cursor, sql, params)
+                cls.manager_class._commit(db)
         except Exception as e:
             raise DeletionFailed(e)
+        self._deleted()
 
-    def save(self):
-        """update instance in db if it exists, otherwise create and update id in instance state"""
-        cls = type(self)
-        db = cls._db
-        cursor = db.cursor()
-        id = self._state.get('id')
-        if id:
-            sql, vals = self._get_update_sql()
-            cursor.execute(sql, vals)
+    async def adelete(self):
+        """Delete instance in db"""
+        try:
+            async with type(self).manager_class._aconnection() as db:
+                sql, params = self._get_delete_sql()
+                await db.execute(sql, params)
+                await db.commit()
+        except Exception as e:
+            raise DeletionFailed(e)
+        self._deleted()
+
+    def _deleted(self):
+        type(self).manager_class._invalidate(type(self), delete=True)
+        session = current_session()
+        if session is not None:
+            session.discard(self)
+
+    def refresh(self):
+        """reload instance values from db, also for instances held by a session"""
+        return type(self).objects.refresh(self)
+
+    def get_dirty_fields(self):
+        """columns changed since the instance was loaded or saved (all of them for new instances)"""
+        if self._loaded is None:
+            return list(self._meta.columns)
+        columns, values = self._loaded
+        loaded = dict(zip(columns, values))
+        dirty = []
+        for column in self._meta.columns:
+            if column in loaded:
+                if getattr(self, column) != loaded[column]:
+                    dirty.append(column)
+            elif hasattr(self, column):
+                dirty.append(column)
+        return dirty
+
+    def _get_save_sql(self, update_fields=None):
+        """
+        (sql, values) for save(): an UPDATE of the changed columns (or update_fields),
+        an INSERT for new instances, or None when there is nothing to write
+        """
+        if not self.id:
+            return self._get_insert_sql()
+        if update_fields is None:
+            update_fields = self.get_dirty_fields()
         else:
-            sql, vals = self._get_insert_sql()
-            cursor.execute(sql, vals)
-            res = cursor.fetchone()
-            self._state['id'] = res[0]
-        db.commit()
-
+            unknown = set(update_fields) - set(self._meta.columns)
+            if unknown:
+                raise ValueError(f"Unknown update_fields for {type(self).__name__}: {', '.join(sorted(unknown))}")
+        if not update_fields:
+            return None
+        return self._get_update_sql(update_fields)
+
+    def _saved(self):
+        type(self).manager_class._invalidate(type(self))
+        self._snapshot()
+        session = current_session()
+        if session is not None:
+            session.add(self)
         return self
+
+    def save(self, update_fields=None):
+        """
+        update instance in db if it exists, otherwise create and update id in instance state.
+        updates only write changed columns (or update_fields) and are skipped when nothing changed
+        """
+        cls = type(self)
+        statement = self._get_save_sql(update_fields)
+        if statement is None:
+            return self
+
+        with cls.manager_class._connection() as db:
+            cursor = db.cursor()
+            cls.manager_class._execute(cursor, *statement)
+            if not self.id:
+                self.id = cursor.fetchone()[0]
+            cls.manager_class._commit(db)
+        return self._saved()
+
+    async def asave(self, update_fields=None):
+        """ async version of save() """
+        statement = self._get_save_sql(update_fields)
+        if statement is None:
+            return self
+
+        async with type(self).manager_class._aconnection() as db:
+            cursor = await db.execute(*statement)
+            if not self.id:
+                self.id = (await cursor.fetchone())[0]
+            await db.commit()
+        return self._saved()
@@ -0,0 +1,82 @@
+"""
+Micro benchmarks for model instances, run with: python benchmark.py
+Importing the models needs the database from settings.py to be reachable
+"""
+from datetime import datetime, timezone
+import timeit
+import tracemalloc
+
+from models import Message
+
+N = 100_000
+NOW = datetime.now(timezone.utc)
+
+
+def build():
+    return Message(content='content', body='body', count=1, tries=1.5, is_active=True, date_created=NOW, user_id=1)
+
+
+def bench_memory():
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [build() for _ in range(N)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del instances
+    return (after - before) / N
+
+
+def bench_attribute_read():
+    msg = build()
+    return min(timeit.repeat(lambda: (msg.content, msg.count, msg.user_id, msg.id), number=N, repeat=5)) / N
+
+
+def bench_attribute_write():
+    msg = build()
+
+    def write():
+        msg.count = 2
+        msg.content = 'changed'
+
+    return min(timeit.repeat(write, number=N, repeat=5)) / N
+
+
+def bench_method_lookup():
+    msg = build()
+    return min(timeit.repeat(lambda: msg._get_delete_sql, number=N, repeat=5)) / N
+
+
+def bench_hydrate():
+    """ per row cost of turning driver tuples into instances, __init__ + setattr vs from_db """
+    columns = Message._meta.all_columns
+    rows = [(i, 'body', 'content', 1, NOW, True, 1.5, 1) for i in range(N)]
+
+    def with_init():
+        for row in rows:
+            instance = Message()
+            for column, value in zip(columns, row):
+                setattr(instance, column, value)
+
+    def with_from_db():
+        from_db = Message.from_db
+        for row in rows:
+            from_db(columns, row)
+
+    init_time = min(timeit.repeat(with_init, number=1, repeat=3)) / N
+    from_db_time = min(timeit.repeat(with_from_db, number=1, repeat=3)) / N
+    return init_time, from_db_time
+
+
+def bench_construct():
+    return min(timeit.repeat(build, number=N // 10, repeat=5)) / (N // 10)
+
+
+if __name__ == '__main__':
+    print(f"memory per instance: {bench_memory():8.0f} bytes")
+    print(f"construct instance:  {bench_construct() * 1e9:8.0f} ns")
+    print(f"read 4 attributes:   {bench_attribute_read() * 1e9:8.0f} ns")
+    print(f"write 2 attributes:  {bench_attribute_write() * 1e9:8.0f} ns")
+    print(f"method lookup:       {bench_method_lookup() * 1e9:8.0f} ns")
+    init_time, from_db_time = bench_hydrate()
+    print(f"hydrate row, init:   {init_time * 1e9:8.0f} ns")
+    print(f"hydrate row, from_db:{from_db_time * 1e9:8.0f} ns")
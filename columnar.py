@@ -0,0 +1,96 @@
+"""
+Queryset results as numpy arrays, one per column. numpy is an optional
+dependency only imported when Queryset.to_columns() is called
+"""
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError('Queryset.to_columns() requires numpy, pip install numpy') from e
+    return numpy
+
+
+class ColumnSpec():
+    """ how one selected column is fetched and stored """
+
+    def __init__(self, name, dtype, nullable, sql):
+        self.name = name
+        self.dtype = dtype
+        self.nullable = nullable
+        self.sql = sql
+
+    @property
+    def storage_dtype(self):
+        """ dtype of the values fetched from the cursor, datetimes arrive as int64 microseconds """
+        return 'int64' if self.dtype.startswith('datetime64') else self.dtype
+
+
+def column_specs(model, columns, annotations=()):
+    """ specs for the selected columns followed by the annotated aggregates """
+    fields = {col.column: col.field for col in model._meta.fields}
+    specs = []
+    for column in columns:
+        field = fields.get(column)
+        if field is None:
+            # the implicit id primary key
+            specs.append(ColumnSpec(column, 'int64', False, column))
+        else:
+            specs.append(ColumnSpec(column, field.numpy_dtype, field.nullable, field.to_column_sql(column)))
+    for alias, aggregate in annotations:
+        specs.append(ColumnSpec(alias, aggregate.numpy_dtype, aggregate.nullable, None))
+    return specs
+
+
+def _chunk_array(np, spec, values):
+    """ array (and mask for nullable columns) for one column of a chunk of rows """
+    count = len(values)
+    dtype = spec.storage_dtype
+    if dtype == 'object':
+        array = np.empty(count, dtype=object)
+        array[:] = values
+        mask = None
+        if spec.nullable:
+            mask = np.fromiter((value is None for value in values), dtype=bool, count=count)
+        return array, mask
+
+    if not spec.nullable:
+        return np.fromiter(values, dtype=dtype, count=count), None
+    mask = np.fromiter((value is None for value in values), dtype=bool, count=count)
+    if mask.any():
+        fill = np.zeros(1, dtype=dtype)[0]
+        values = [fill if value is None else value for value in values]
+    return np.fromiter(values, dtype=dtype, count=count), mask
+
+
+def rows_to_columns(specs, chunks):
+    """
+    build {column name: array} from an iterable of row chunks. Each chunk is
+    converted column by column, nullable fields become masked arrays and
+    datetimes datetime64[us] arrays (UTC)
+    """
+    np = _import_numpy()
+    parts = [[] for _ in specs]
+    masks = [[] for _ in specs]
+    for chunk in chunks:
+        if not chunk:
+            continue
+        for i, (spec, values) in enumerate(zip(specs, zip(*chunk))):
+            array, mask = _chunk_array(np, spec, values)
+            parts[i].append(array)
+            masks[i].append(mask)
+
+    result = {}
+    for spec, arrays, column_masks in zip(specs, parts, masks):
+        if arrays:
+            array = np.concatenate(arrays)
+        else:
+            array = np.empty(0, dtype=spec.storage_dtype)
+        if spec.storage_dtype != spec.dtype:
+            array = array.astype(spec.dtype)
+        if spec.nullable:
+            mask = np.concatenate(column_masks) if column_masks else np.zeros(0, dtype=bool)
+            array = np.ma.MaskedArray(array, mask=mask)
+        result[spec.name] = array
+    return result
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
@@ -13,7 +15,7 @@ def test_client_db(create_test_db, models, test_db_connection):
     creates test database and models and drops db at end of session
     lasts entire pytest session prior to teardown
     """
-    BaseManager.connection = test_db_connection
+    BaseManager.set_connection(TEST_DB_SETTINGS)
     Job.objects.create_table()
     User.objects.create_table()
     Message.objects.create_table()
@@ -21,7 +23,9 @@ def test_client_db(create_test_db, models, test_db_connection):
     models.append(Message)
     models.append(User)
     yield models
-    MetaModel.manager_class.connection.close()
+    MetaModel.manager_class.pool.closeall()
+    asyncio.run(MetaModel.manager_class.async_pool.close())
+    test_db_connection.close()
     drop_test_db()
     return
 
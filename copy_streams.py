@@ -0,0 +1,40 @@
+class CopyInStream():
+    """
+    File like object that lazily encodes rows for cursor.copy_expert.
+    Only enough rows to satisfy each read() are pulled from the iterable
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        buffered = len(self._buffer)
+        while size < 0 or buffered < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            buffered += len(line)
+
+        data = ''.join(chunks)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def iter_copy_lines(model, rows):
+    """ yield one COPY text format line per model instance or dict """
+    meta = model._meta
+    for row in rows:
+        if isinstance(row, dict):
+            values = [row.get(column, meta.defaults[column]) for column in meta.columns]
+        else:
+            values = [getattr(row, column) for column in meta.columns]
+        yield '\t'.join(
+            col.field.to_copy_text(value) for col, value in zip(meta.fields, values)
+        ) + '\n'
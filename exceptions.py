@@ -12,3 +12,15 @@ class MaxLengthRequired(Exception):
 
 class DeletionFailed(Exception):
     pass
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class InvalidLookup(Exception):
+    pass
+
+
+class InvalidRelation(Exception):
+    pass
@@ -1,15 +1,39 @@
 
 
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+COPY_NULL = '\\N'
+
+
 class BaseField():
     """ Base model that all DB fields inherit from"""
 
+    # numpy dtype used by Queryset.to_columns()
+    numpy_dtype = 'object'
+    # set by the subclass constructors, index=True / unique=True make create_table() add an index
+    index = False
+    unique = False
+
+    def to_column_sql(self, column):
+        """ select expression for Queryset.to_columns() """
+        return column
+
+    def to_copy_text(self, value):
+        """ encode value for postgres COPY text format """
+        if value is None:
+            return COPY_NULL
+        return str(value).translate(COPY_ESCAPES)
+
 
 class IntegerField(BaseField):
     """ Integer field for database """
 
-    def __init__(self, nullable=False, default=None):
+    numpy_dtype = 'int64'
+
+    def __init__(self, nullable=False, default=None, index=False, unique=False):
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     @property
     def get_sql_text(self):
@@ -20,9 +44,14 @@ class IntegerField(BaseField):
 
 class FloatField(BaseField):
     """ Float field for database """
-    def __init__(self, nullable=False, default=None):
+
+    numpy_dtype = 'float64'
+
+    def __init__(self, nullable=False, default=None, index=False, unique=False):
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     @property
     def get_sql_text(self):
@@ -30,14 +59,21 @@ class FloatField(BaseField):
         nullable = "" if self.nullable else " NOT NULL"
         return BASE_SQL.format(nullable=nullable)
 
+    def to_copy_text(self, value):
+        if isinstance(value, float):
+            return repr(value)
+        return super().to_copy_text(value)
+
 
 class CharField(BaseField):
     """ String field for database """
 
-    def __init__(self, max_length=255, nullable=False, default=None):
+    def __init__(self, max_length=255, nullable=False, default=None, index=False, unique=False):
         self.max_length = max_length
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     @property
     def get_sql_text(self):
@@ -48,9 +84,14 @@ class CharField(BaseField):
 
 class DateTimeField(BaseField):
     """ Datetime field for database """
-    def __init__(self, nullable=False, default=None):
+
+    numpy_dtype = 'datetime64[us]'
+
+    def __init__(self, nullable=False, default=None, index=False, unique=False):
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     @property
     def get_sql_text(self):
@@ -58,12 +99,26 @@ class DateTimeField(BaseField):
         nullable = "" if self.nullable else " NOT NULL"
         return BASE_SQL.format(nullable=nullable)
 
+    def to_column_sql(self, column):
+        """ microseconds since the epoch (UTC), so rows hold ints instead of datetime objects """
+        return f"(EXTRACT(EPOCH FROM {column}) * 1000000)::bigint"
+
+    def to_copy_text(self, value):
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return super().to_copy_text(value)
+
 
 class BooleanField(BaseField):
     """ Boolean field for database """
-    def __init__(self, nullable=False, default=None):
+
+    numpy_dtype = 'bool'
+
+    def __init__(self, nullable=False, default=None, index=False, unique=False):
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     @property
     def get_sql_text(self):
@@ -71,18 +126,28 @@ class BooleanField(BaseField):
         nullable = "" if self.nullable else " NOT NULL"
         return BASE_SQL.format(nullable=nullable)
 
+    def to_copy_text(self, value):
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return super().to_copy_text(value)
+
     @property
     def get_default_value(self):
         return self.default
 
 
 class ForeignKey(BaseField):
-    """ Foreign Key field for database """
+    """ Foreign Key field for database, indexed unless index=False """
+
+    numpy_dtype = 'int64'
 
-    def __init__(self, model, nullable=False, default=None, on_delete='DO NOTHING'):
+    def __init__(self, model, nullable=False, default=None, on_delete='DO NOTHING', index=True,
+                 unique=False):
         self.model = model
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
         self.on_delete = on_delete
 
     def get_fk_text(self, name):
@@ -98,9 +163,11 @@ class ForeignKey(BaseField):
 class TextField(BaseField):
     """ Text field for database """
 
-    def __init__(self, nullable=False, default=None):
+    def __init__(self, nullable=False, default=None, index=False, unique=False):
         self.nullable = nullable
         self.default = default
+        self.index = index
+        self.unique = unique
 
     @property
     def get_sql_text(self):
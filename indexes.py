@@ -0,0 +1,68 @@
+import hashlib
+
+
+# postgres truncates longer identifiers
+MAX_NAME_LENGTH = 63
+
+
+class Index():
+    """
+    Index on one or more columns, declared in a model's Meta class.
+    Prefix a column with '-' for descending order; where is a sql condition
+    making it a partial index
+
+        class Message(Model):
+            ...
+            class Meta:
+                indexes = [
+                    Index('user_id', '-date_created'),
+                    Index('content', where='is_active', name='active_content_idx'),
+                ]
+    """
+
+    def __init__(self, *columns, name=None, unique=False, where=None):
+        if not columns:
+            raise ValueError('An index needs at least one column')
+        self.columns = columns
+        self.name = name
+        self.unique = unique
+        self.where = where
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"Index({', '.join(map(repr, self.columns))}, unique={self.unique}, where={self.where!r})"
+
+    def _key(self):
+        return (self.columns, self.name, self.unique, self.where)
+
+    def get_name(self, table_name):
+        if self.name is not None:
+            return self.name
+        suffix = 'uniq' if self.unique else 'idx'
+        name = "{table_name}_{columns}_{suffix}".format(
+            table_name=table_name,
+            columns="_".join(column.lstrip('-') for column in self.columns),
+            suffix=suffix
+        )
+        if len(name) > MAX_NAME_LENGTH:
+            digest = hashlib.sha1(name.encode()).hexdigest()[:8]
+            name = f"{name[:MAX_NAME_LENGTH - len(suffix) - 10]}_{digest}_{suffix}"
+        return name
+
+    def create_sql(self, table_name, concurrently=False):
+        columns = [f"{column[1:]} DESC" if column.startswith('-') else column for column in self.columns]
+        sql = "CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name} ON {table_name} ({columns})".format(
+            unique='UNIQUE ' if self.unique else '',
+            concurrently='CONCURRENTLY ' if concurrently else '',
+            name=self.get_name(table_name),
+            table_name=table_name,
+            columns=", ".join(columns)
+        )
+        if self.where:
+            sql = f"{sql} WHERE {self.where}"
+        return f"{sql};"
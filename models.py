@@ -2,11 +2,12 @@ from datetime import datetime, timezone
 
 from base_orm import Model
 import fields
+from indexes import Index
 
 
 class User(Model):
 
-    email = fields.CharField(max_length=255)
+    email = fields.CharField(max_length=255, index=True)
     first_name = fields.CharField(max_length=255)
     last_name = fields.CharField(max_length=255)
     is_active = fields.BooleanField()
@@ -26,6 +27,11 @@ class Message(Model):
     date_created = fields.DateTimeField(nullable=True)
     user = fields.ForeignKey(User, nullable=True, on_delete='SET NULL')
 
+    class Meta:
+        indexes = [
+            Index('user_id', '-date_created'),
+        ]
+
     def __repr__(self):
         return f"{self.content}"
 
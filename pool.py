@@ -0,0 +1,377 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import threading
+import time
+
+from psycopg2 import extensions
+
+from exceptions import PoolTimeout
+
+
+def check_connection(connection):
+    """ cheap health check, no round trip to the server """
+    return (
+        not connection.closed and
+        connection.get_transaction_status() != extensions.TRANSACTION_STATUS_UNKNOWN
+    )
+
+
+def ping_connection(connection):
+    """ health check that runs a trivial query on the server """
+    if not check_connection(connection):
+        return False
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1;")
+        cursor.fetchone()
+        connection.rollback()
+    except Exception:
+        return False
+    return True
+
+
+class ConnectionPool():
+    """
+    Thread safe pool of database connections.
+    Connections are borrowed with getconn() / the connection() context manager
+    and given back with putconn(). Any transaction left open is rolled back when a
+    connection is returned so one failed request cannot poison the next one
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0, max_lifetime=3600.0,
+                 health_check=check_connection):
+        if min_size > max_size:
+            raise ValueError('min_size can not be larger than max_size')
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+
+        self._idle = []
+        self._in_use = set()
+        self._created = {}
+        # connections being opened outside the lock, counted against max_size
+        self._opening = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._checkouts = 0
+        self._waiting = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        with self._cond:
+            for _ in range(min_size):
+                self._idle.append(self._new_connection())
+
+    def __len__(self):
+        return len(self._created)
+
+    # helper methods
+
+    def _new_connection(self):
+        connection = self._connect()
+        self._created[id(connection)] = time.monotonic()
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _expired(self, connection):
+        if self.max_lifetime is None:
+            return False
+        return time.monotonic() - self._created[id(connection)] > self.max_lifetime
+
+    def _open(self):
+        """ connect for a slot reserved by incrementing _opening, called without the lock """
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opening -= 1
+            self._created[id(connection)] = time.monotonic()
+            self._in_use.add(connection)
+        return connection
+
+    # public methods
+
+    def getconn(self):
+        """
+        borrow a connection, waiting up to timeout seconds for one to be free.
+        the lock is only held to reserve an idle connection or a slot for a new one,
+        health checks, closing and connecting happen outside of it
+        """
+        start = time.monotonic()
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout('Connection pool is closed')
+            self._waiting += 1
+            try:
+                while not self._idle and len(self._created) + self._opening >= self.max_size:
+                    remaining = None if self.timeout is None else self.timeout - (time.monotonic() - start)
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout(
+                            f"No connection available after {self.timeout} seconds ({self.max_size} in use)"
+                        )
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            if self._idle:
+                connection = self._idle.pop()
+                self._in_use.add(connection)
+            else:
+                connection = None
+                self._opening += 1
+
+        if connection is not None and (self._expired(connection) or not self.health_check(connection)):
+            # replace it with a new connection in the same slot
+            with self._cond:
+                self._in_use.discard(connection)
+                self._created.pop(id(connection), None)
+                self._opening += 1
+            self._close(connection)
+            connection = None
+        if connection is None:
+            connection = self._open()
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+        return connection
+
+    def putconn(self, connection, close=False):
+        """ give a borrowed connection back to the pool, rolling back any open transaction """
+        close = close or connection.closed
+        if not close:
+            try:
+                if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except Exception:
+                close = True
+        with self._cond:
+            self._in_use.discard(connection)
+            if (close or self._closed or connection.closed or id(connection) not in self._created or
+                    self._expired(connection)):
+                self._created.pop(id(connection), None)
+            else:
+                self._idle.append(connection)
+                connection = None
+            self._cond.notify()
+        if connection is not None:
+            self._close(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            connections = self._idle + list(self._in_use)
+            for connection in connections:
+                self._created.pop(id(connection), None)
+            self._idle = []
+            self._in_use = set()
+            self._cond.notify_all()
+        for connection in connections:
+            self._close(connection)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': len(self._created),
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'total_wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+            }
+
+
+async def async_connect(**kwargs):
+    """
+    open an asyncio connection with psycopg 3, imported lazily so the sync api does not need it.
+    text is decoded as utf8 like psycopg2 does, psycopg 3 returns bytes for SQL_ASCII databases
+    """
+    import psycopg
+    kwargs.setdefault('client_encoding', 'utf8')
+    return await psycopg.AsyncConnection.connect(**kwargs)
+
+
+class AsyncConnectionPool():
+    """
+    asyncio counterpart of ConnectionPool.
+    Connections are opened on demand up to max_size; coroutines wait on the pool
+    instead of blocking the event loop. Open transactions are rolled back when a
+    connection is returned
+    """
+
+    def __init__(self, connect, max_size=10, timeout=30.0, max_lifetime=3600.0):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+
+        self._idle = []
+        self._in_use = set()
+        self._created = {}
+        self._opening = 0
+        self._cond = None
+        self._loop = None
+        self._closed = False
+
+        self._checkouts = 0
+        self._waiting = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def __len__(self):
+        return len(self._created)
+
+    # helper methods
+
+    def _condition(self):
+        """
+        asyncio primitives are bound to one event loop; connections opened on a
+        loop that is gone (eg. between asyncio.run calls) can not be reused
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            for connection in self._idle + list(self._in_use):
+                connection.pgconn.finish()
+            self._idle = []
+            self._in_use = set()
+            self._created = {}
+            self._opening = 0
+            self._cond = asyncio.Condition()
+            self._loop = loop
+        return self._cond
+
+    async def _discard(self, connection):
+        self._created.pop(id(connection), None)
+        try:
+            await connection.close()
+        except Exception:
+            pass
+
+    def _expired(self, connection):
+        if self.max_lifetime is None:
+            return False
+        return time.monotonic() - self._created[id(connection)] > self.max_lifetime
+
+    # public methods
+
+    async def getconn(self):
+        """ borrow a connection, waiting up to timeout seconds for one to be free """
+        start = time.monotonic()
+        cond = self._condition()
+        async with cond:
+            if self._closed:
+                raise PoolTimeout('Connection pool is closed')
+            self._waiting += 1
+            try:
+                while not self._idle and len(self._created) + self._opening >= self.max_size:
+                    remaining = None if self.timeout is None else self.timeout - (time.monotonic() - start)
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout(
+                            f"No connection available after {self.timeout} seconds ({self.max_size} in use)"
+                        )
+                    try:
+                        await asyncio.wait_for(cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting -= 1
+
+            connection = None
+            while self._idle:
+                candidate = self._idle.pop()
+                if self._expired(candidate) or candidate.closed:
+                    await self._discard(candidate)
+                    continue
+                connection = candidate
+                break
+            if connection is None:
+                self._opening += 1
+
+        if connection is None:
+            try:
+                connection = await self._connect()
+            finally:
+                async with cond:
+                    self._opening -= 1
+                    cond.notify()
+            self._created[id(connection)] = time.monotonic()
+
+        self._in_use.add(connection)
+        waited = time.monotonic() - start
+        self._checkouts += 1
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+        return connection
+
+    async def putconn(self, connection, close=False):
+        """ give a borrowed connection back to the pool """
+        from psycopg import pq
+
+        cond = self._condition()
+        self._in_use.discard(connection)
+        if not close and not connection.closed:
+            try:
+                if connection.info.transaction_status != pq.TransactionStatus.IDLE:
+                    await connection.rollback()
+            except Exception:
+                close = True
+        if close or self._closed or connection.closed or id(connection) not in self._created or \
+                self._expired(connection):
+            await self._discard(connection)
+        else:
+            self._idle.append(connection)
+        async with cond:
+            cond.notify()
+
+    @asynccontextmanager
+    async def connection(self):
+        connection = await self.getconn()
+        try:
+            yield connection
+        finally:
+            await self.putconn(connection)
+
+    async def close(self):
+        self._condition()
+        self._closed = True
+        for connection in self._idle + list(self._in_use):
+            await self._discard(connection)
+        self._idle = []
+        self._in_use = set()
+        async with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'size': len(self._created),
+            'in_use': len(self._in_use),
+            'idle': len(self._idle),
+            'waiting': self._waiting,
+            'checkouts': self._checkouts,
+            'total_wait_time': self._wait_time,
+            'max_wait_time': self._max_wait_time,
+        }
@@ -0,0 +1,273 @@
+from exceptions import InvalidLookup, InvalidRelation
+from statements import statement_cache
+
+
+LOOKUPS = {
+    'exact': '{column}=%s',
+    'gt': '{column} > %s',
+    'gte': '{column} >= %s',
+    'lt': '{column} < %s',
+    'lte': '{column} <= %s',
+    'in': '{column} = ANY(%s)',
+    'range': '{column} BETWEEN %s AND %s',
+    'startswith': "{column} LIKE %s",
+}
+
+
+def build_lookup(key, value):
+    """
+    turn a 'column__lookup' kwarg into a sql fragment and its params.
+    __in binds the whole list as a single array parameter so the sql text
+    does not depend on the number of values
+    """
+    column, _, lookup = key.rpartition('__')
+    if not column:
+        column, lookup = key, 'exact'
+
+    if lookup == 'isnull':
+        return f"{column} IS NULL" if value else f"{column} IS NOT NULL", ()
+    if lookup not in LOOKUPS:
+        raise InvalidLookup(f"Unsupported lookup '{lookup}' in '{key}'")
+
+    if lookup == 'in':
+        params = (list(value),)
+    elif lookup == 'range':
+        low, high = value
+        params = (low, high)
+    elif lookup == 'startswith':
+        escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params = (f"{escaped}%",)
+    else:
+        params = (value,)
+    return LOOKUPS[lookup].format(column=column), params
+
+
+class Query():
+    """
+    Structured representation of a select statement.
+    Querysets modify a Query while chaining; it is compiled to sql only when
+    the queryset is executed, and compiled text is cached by query shape
+    """
+
+    def __init__(self, model, columns=None):
+        self.model = model
+        self.columns = tuple(columns) if columns is not None else model._meta.all_columns
+        self.conditions = ()
+        self.params = ()
+        self.ordering = ()
+        self.low_mark = 0
+        self.high_mark = None
+        self.related = ()
+        self.annotations = ()
+        # (column, sql) pairs selecting an expression in place of a column, under the column's name
+        self.expressions = ()
+        self.having = ()
+        self.having_params = ()
+
+    def clone(self):
+        """ shallow copy, every attribute is immutable so nothing is shared by mutation """
+        obj = Query.__new__(Query)
+        obj.__dict__ = self.__dict__.copy()
+        return obj
+
+    # helper methods
+
+    def _shape(self):
+        """ hashable description of everything that changes the sql text """
+        return (self.model, self.columns, self.conditions, self.ordering, self.low_mark, self.high_mark, self.related,
+                self.annotations, self.expressions, self.having)
+
+    def _from_where_sql(self):
+        sql = "FROM {table_name}".format(table_name=self.model._meta.table_name)
+        if self.conditions:
+            sql = "{sql} WHERE {conditions}".format(sql=sql, conditions=" AND ".join(self.conditions))
+        return sql
+
+    def _order_by_sql(self):
+        ordered_fields = [f"{field[1:]} DESC" if field.startswith('-') else f"{field}" for field in self.ordering]
+        return "ORDER BY {ordered_fields}".format(ordered_fields=", ".join(ordered_fields))
+
+    def _limit_sql(self):
+        clauses = []
+        if self.high_mark is not None:
+            clauses.append(f"LIMIT {self.high_mark - self.low_mark}")
+        if self.low_mark:
+            clauses.append(f"OFFSET {self.low_mark}")
+        return " ".join(clauses)
+
+    def _compile_select(self):
+        expressions = dict(self.expressions)
+        columns = [f"{expressions[column]} AS {column}" if column in expressions else column for column in self.columns]
+        columns.extend(f"{aggregate.as_sql()} AS {alias}" for alias, aggregate in self.annotations)
+        clauses = ["SELECT {columns}".format(columns=", ".join(columns)), self._from_where_sql()]
+        if self.annotations and self.columns:
+            clauses.append("GROUP BY {columns}".format(columns=", ".join(self.columns)))
+        if self.having:
+            clauses.append("HAVING {conditions}".format(conditions=" AND ".join(self.having)))
+        if self.ordering:
+            clauses.append(self._order_by_sql())
+        if self.is_sliced:
+            clauses.append(self._limit_sql())
+        return " ".join(clauses)
+
+    def _compile_select_related(self):
+        """
+        LEFT JOIN each related table onto the plain select, wrapped as a subquery
+        so conditions, ordering and limits keep applying to the base table only
+        """
+        columns = [f"base.{column}" for column in self.columns]
+        columns.extend(f"base.{alias}" for alias, _ in self.annotations)
+        joins = []
+        for alias, (name, rel_model, _, _) in zip(self._join_aliases(), self.related_layout()):
+            rel_meta = rel_model._meta
+            columns.extend(f"{alias}.{column}" for column in rel_meta.all_columns)
+            joins.append("LEFT JOIN {table_name} AS {alias} ON {alias}.id = base.{fk_column}".format(
+                table_name=rel_meta.table_name,
+                alias=alias,
+                fk_column=self.model._meta.relations[name].column
+            ))
+        clauses = [
+            "SELECT {columns} FROM ({subquery}) AS base".format(
+                columns=", ".join(columns),
+                subquery=self._compile_select()
+            )
+        ]
+        clauses.extend(joins)
+        if self.ordering:
+            ordered_fields = [f"base.{field[1:]} DESC" if field.startswith('-') else f"base.{field}"
+                              for field in self.ordering]
+            clauses.append("ORDER BY {ordered_fields}".format(ordered_fields=", ".join(ordered_fields)))
+        return " ".join(clauses)
+
+    def _compile_select_statement(self):
+        if self.related:
+            return "{select};".format(select=self._compile_select_related())
+        return "{select};".format(select=self._compile_select())
+
+    def _join_aliases(self):
+        return [f"T{i}" for i in range(1, len(self.related) + 1)]
+
+    def _compile_aggregate(self, aggregates):
+        """ one row of aggregates over the rows (or groups, when annotated) the query selects """
+        selected = ", ".join(f"{aggregate.as_sql()} AS {alias}" for alias, aggregate in aggregates)
+        if not self.is_sliced and not self.annotations:
+            return "SELECT {selected} {from_where};".format(selected=selected, from_where=self._from_where_sql())
+        inner = self.clone()
+        if not self.annotations:
+            # aggregated columns need not be among the selected ones
+            inner.columns = self.model._meta.all_columns
+        return "SELECT {selected} FROM ({subquery}) AS subquery;".format(
+            selected=selected,
+            subquery=inner._compile_select()
+        )
+
+    def _compile_count(self):
+        if self.is_sliced or self.annotations:
+            return "SELECT COUNT(*) FROM ({subquery}) AS subquery;".format(subquery=self._compile_select())
+        return "SELECT COUNT(*) {from_where};".format(from_where=self._from_where_sql())
+
+    def _compile_exists(self):
+        if self.is_sliced or self.annotations:
+            return "SELECT 1 FROM ({subquery}) AS subquery LIMIT 1;".format(subquery=self._compile_select())
+        return "SELECT 1 {from_where} LIMIT 1;".format(from_where=self._from_where_sql())
+
+    # public methods
+
+    @property
+    def is_sliced(self):
+        return bool(self.low_mark) or self.high_mark is not None
+
+    def add_condition(self, sql, params=()):
+        """ AND a sql fragment with %s placeholders onto the WHERE clause """
+        self.conditions += (sql,)
+        self.params += tuple(params)
+
+    def add_annotations(self, **annotations):
+        """ aggregates selected per group of the selected columns, by alias """
+        self.annotations += tuple(annotations.items())
+
+    def add_filter(self, **kwargs):
+        """
+        lookup conditions, names sorted so kwarg order does not change the sql.
+        lookups on annotation aliases become HAVING conditions on the aggregate
+        """
+        aliases = dict(self.annotations)
+        fragments = []
+        params = []
+        having = []
+        having_params = []
+        for key in sorted(kwargs):
+            column, _, lookup = key.partition('__')
+            if column in aliases:
+                target = aliases[column].as_sql() + (f"__{lookup}" if lookup else '')
+                fragment, values = build_lookup(target, kwargs[key])
+                having.append(fragment)
+                having_params.extend(values)
+            else:
+                fragment, values = build_lookup(key, kwargs[key])
+                fragments.append(fragment)
+                params.extend(values)
+        if fragments:
+            self.add_condition(" AND ".join(fragments), params)
+        if having:
+            self.having += (" AND ".join(having),)
+            self.having_params += tuple(having_params)
+
+    def add_related(self, *names):
+        """ foreign key fields to LEFT JOIN and load along with each row """
+        relations = self.model._meta.relations
+        for name in names:
+            if name not in relations:
+                raise InvalidRelation(f"'{name}' is not a foreign key on {self.model.__name__}")
+        self.related += tuple(name for name in names if name not in self.related)
+
+    def related_layout(self):
+        """ (field name, related model, first column index, end column index) per joined relation """
+        layout = []
+        # joined columns follow the selected columns and annotations
+        start = len(self.columns) + len(self.annotations)
+        for name in self.related:
+            rel_model = self.model._meta.relations[name].field.model
+            end = start + len(rel_model._meta.all_columns)
+            layout.append((name, rel_model, start, end))
+            start = end
+        return layout
+
+    def tables(self):
+        """ tables read by the select statement """
+        return (self.model._meta.table_name,) + tuple(
+            rel_model._meta.table_name for _, rel_model, _, _ in self.related_layout()
+        )
+
+    def set_limits(self, low=None, high=None):
+        """ narrow the current limits, offsets are relative to any previous slice """
+        if high is not None:
+            if self.high_mark is not None:
+                self.high_mark = min(self.high_mark, self.low_mark + high)
+            else:
+                self.high_mark = self.low_mark + high
+        if low is not None:
+            if self.high_mark is not None:
+                self.low_mark = min(self.high_mark, self.low_mark + low)
+            else:
+                self.low_mark = self.low_mark + low
+
+    def compile(self, kind='select'):
+        """ return (sql, params) for a 'select', 'count' or 'exists' statement """
+        compilers = {
+            'select': self._compile_select_statement,
+            'count': self._compile_count,
+            'exists': self._compile_exists,
+        }
+        if kind not in compilers:
+            raise ValueError(f"Unknown statement kind {kind}")
+        sql = statement_cache.get_or_compile((kind,) + self._shape(), compilers[kind])
+        return sql, list(self.params + self.having_params)
+
+    def compile_aggregate(self, aggregates):
+        """ return (sql, params) computing aggregates, a tuple of (alias, Aggregate) pairs """
+        sql = statement_cache.get_or_compile(
+            ('aggregate', aggregates) + self._shape(),
+            lambda: self._compile_aggregate(aggregates)
+        )
+        return sql, list(self.params + self.having_params)
@@ -1,4 +1,12 @@
-from collections import OrderedDict
+import base64
+from datetime import date, datetime
+import json
+from uuid import uuid4
+
+from columnar import column_specs, rows_to_columns
+from exceptions import InvalidRelation
+from sessions import current_session
+from statements import statement_cache
 
 
 class EmptyObj():
@@ -6,39 +14,186 @@ class EmptyObj():
     pass
 
 
+def _encode_key(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError(f"Can not use {type(value).__name__} in a page token")
+
+
+def _decode_key(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def encode_page_token(key):
+    """ opaque continuation token for a keyset page """
+    data = json.dumps(list(key), default=_encode_key, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    return json.loads(base64.urlsafe_b64decode(token.encode('ascii')), object_hook=_decode_key)
+
+
+def _prefetch_plan(model, instances, name):
+    """
+    queryset loading one relation for the instances (None when nothing to load)
+    and a function attaching its results to the instances
+    """
+    meta = model._meta
+    if name in meta.relations:
+        col = meta.relations[name]
+        ids = list({getattr(instance, col.column) for instance in instances} - {None})
+        queryset = col.field.model.objects.where(id__in=ids) if ids else None
+
+        def attach(objs):
+            related = {obj.id: obj for obj in objs}
+            for instance in instances:
+                setattr(instance, name, related.get(getattr(instance, col.column)))
+
+        return queryset, attach
+
+    if name in meta.reverse_relations:
+        rel_model, col = meta.reverse_relations[name]
+        lookup = {f"{col.column}__in": [instance.id for instance in instances]}
+        queryset = rel_model.objects.where(**lookup).order_by('id')
+
+        def attach(objs):
+            grouped = {}
+            for obj in objs:
+                grouped.setdefault(getattr(obj, col.column), []).append(obj)
+            for instance in instances:
+                setattr(instance, name, grouped.get(instance.id, []))
+
+        return queryset, attach
+
+    raise InvalidRelation(f"'{name}' is not a relation on {model.__name__}")
+
+
+def prefetch_related_objects(model, instances, names):
+    """
+    load the named relations for a list of instances with one query per relation
+    and attach them; foreign keys get the related instance, reverse relations
+    (eg. 'message_set') a list of instances
+    """
+    if not instances:
+        return
+    for name in names:
+        queryset, attach = _prefetch_plan(model, instances, name)
+        attach(list(queryset) if queryset is not None else [])
+
+
+async def aprefetch_related_objects(model, instances, names):
+    """ async version of prefetch_related_objects """
+    if not instances:
+        return
+    for name in names:
+        queryset, attach = _prefetch_plan(model, instances, name)
+        attach(await queryset.alist() if queryset is not None else [])
+
+
+# COPY has no bind parameters, they are inlined with cursor.mogrify.
+# ndjson uses csv format with quote and delimiter characters json never contains
+# unescaped, so the json text is written as is (text format would escape backslashes)
+EXPORT_FORMATS = {
+    'csv': "COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER {header});",
+    'ndjson': "COPY (SELECT row_to_json(export) FROM ({select}) AS export) TO STDOUT "
+              "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02');",
+}
+
+
+class Page():
+    """ one page of keyset pagination results """
+
+    def __init__(self, items, next_token):
+        self.items = items
+        self.next_token = next_token
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.items)
+
+    @property
+    def has_next(self):
+        return self.next_token is not None
+
+
 class Queryset():
     """
     Returns a set of objects. Database not hit until iteration
     """
 
-    def __init__(self, iterable_class, model, cursor, sql, fields, params=None, flat=None):
+    def __init__(self, iterable_class, model, query, flat=None):
         self._result_cache = None
         self._iterable_class = iterable_class
         self.model = model
-        self.cursor = cursor
-        self.sql = sql
-        self.fields = fields
-        self.params = params
+        self.query = query
         self.flat = flat
+        self._prefetch_related = ()
 
     def __getitem__(self, key):
-        self._fetch_all()
-        return self._result_cache[key]
+        """ slices of an unevaluated queryset become LIMIT/OFFSET on a new queryset """
+        if self._result_cache is not None:
+            return self._result_cache[key]
+
+        if isinstance(key, slice):
+            start, stop = key.start or 0, key.stop
+            if start < 0 or (stop is not None and stop < 0) or key.step not in (None, 1):
+                self._fetch_all()
+                return self._result_cache[key]
+            obj = self._chain()
+            obj.query.set_limits(start, stop)
+            return obj
+
+        if key < 0:
+            self._fetch_all()
+            return self._result_cache[key]
+        obj = self._chain()
+        obj.query.set_limits(key, key + 1)
+        return list(obj)[0]
 
     def __iter__(self):
         self._fetch_all()
         return iter(self._result_cache)
 
+    async def __aiter__(self):
+        await self._afetch_all()
+        for item in self._result_cache:
+            yield item
+
     def __len__(self):
         self._fetch_all()
         return len(self._result_cache)
 
     def __repr__(self):
-        data = list(self[:5])
+        data = list(self[:6])
         if len(data) > 5:
             data[-1] = "...(remaining elements truncated)..."
         return "<%s %r>" % (self.__class__.__name__, data)
 
+    @property
+    def fields(self):
+        return self.query.columns + tuple(alias for alias, _ in self.query.annotations)
+
+    @property
+    def ordering(self):
+        return self.query.ordering
+
+    @property
+    def sql(self):
+        """ compiled select statement, for inspection """
+        return self.query.compile()[0]
+
     # helper methods
 
     def _chain(self):
@@ -55,135 +210,492 @@ class Queryset():
         obj = EmptyObj()
         obj.__class__ = self.__class__
         obj.__dict__ = self.__dict__.copy()
-        obj.model = self.model
-        obj.sql = str(self.sql)
-        obj.fields = self.fields.copy()
-        obj.params = self.params.copy() if self.params is not None else None
+        obj._result_cache = None
+        obj.query = self.query.clone()
         return obj
 
+    def _execute(self, chunk_size=None):
+        """
+        run sql on a connection borrowed from the model's pool.
+        returns all rows, or when chunk_size is given a generator streaming rows
+        from a server side cursor chunk_size rows at a time
+        """
+        if chunk_size is not None:
+            return self._stream(chunk_size)
+        return self._execute_sql(*self.query.compile())
+
+    def _execute_sql(self, sql, params):
+        manager_class = self.model.manager_class
+        key = manager_class._cache_key(self.model, self.query.tables(), sql, params)
+        if key is not None:
+            rows = manager_class.result_cache.get(key)
+            if rows is not None:
+                return rows
+
+        with manager_class._connection() as connection:
+            cursor = connection.cursor()
+            manager_class._execute(cursor, sql, params)
+            rows = cursor.fetchall()
+        if key is not None:
+            manager_class.result_cache.set(self.model, key, rows)
+        return rows
+
+    async def _aexecute_sql(self, sql, params):
+        manager_class = self.model.manager_class
+        key = manager_class._cache_key(self.model, self.query.tables(), sql, params)
+        if key is not None:
+            rows = manager_class.result_cache.get(key)
+            if rows is not None:
+                return rows
+
+        async with manager_class._aconnection() as connection:
+            cursor = await connection.execute(sql, params)
+            rows = await cursor.fetchall()
+        if key is not None:
+            manager_class.result_cache.set(self.model, key, rows)
+        return rows
+
+    def _stream(self, chunk_size):
+        """ generator over a named cursor, holds its connection until exhausted or closed """
+        for chunk in self._stream_chunks(chunk_size):
+            yield from chunk
+
+    def _stream_chunks(self, chunk_size):
+        """ lists of up to chunk_size rows fetched from a named cursor """
+        sql, params = self.query.compile()
+        with self.model.manager_class._connection() as connection:
+            cursor = connection.cursor(name=f"orm_{uuid4().hex}")
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    chunk = cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                if not connection.closed:
+                    cursor.close()
+
     def _fetch_all(self):
         """ fill cache if not already full """
 
         if self._result_cache is None:
             self._result_cache = list(self._iterable_class(self))
+            if self._prefetch_related:
+                prefetch_related_objects(self.model, self._result_cache, self._prefetch_related)
 
-    def _filter_fields(self, sql, **kwargs):
-        """helper for 'where' method """
-
-        sql = sql.replace(';', '')
-        SQL = "{orig_sql} WHERE {conditions};"
-        cols = OrderedDict(**kwargs)
-        criteria = [name for name in cols.keys()]
-        values = [val for val in cols.values()]
-        FINAL_SQL = SQL.format(
-            orig_sql=sql,
-            conditions=f"{'=%s AND '.join(criteria)}=%s"
-        )
+    async def _afetch_all(self):
+        """ async version of _fetch_all, rows are fetched first and hydrated by the same iterables """
 
-        return FINAL_SQL, values
+        if self._result_cache is None:
+            rows = await self._aexecute_sql(*self.query.compile())
+            result = list(self._iterable_class(self, rows=rows))
+            if self._prefetch_related:
+                await aprefetch_related_objects(self.model, result, self._prefetch_related)
+            self._result_cache = result
+
+    def _iter_prefetched(self, iterable, chunk_size):
+        """ prefetch relations for a streamed queryset one chunk at a time """
+        chunk = []
+        for instance in iterable:
+            chunk.append(instance)
+            if len(chunk) >= chunk_size:
+                prefetch_related_objects(self.model, chunk, self._prefetch_related)
+                yield from chunk
+                chunk = []
+        prefetch_related_objects(self.model, chunk, self._prefetch_related)
+        yield from chunk
+
+    def _nullable_columns(self, columns):
+        """ which of the columns may hold NULL (model fields declared nullable=True, aggregates) """
+        nullable = {col.column: col.field.nullable for col in self.model._meta.fields}
+        nullable.update((alias, aggregate.nullable) for alias, aggregate in self.query.annotations)
+        return tuple(nullable.get(column, False) for column in columns)
+
+    def _keyset_condition(self, ordering, key):
+        """
+        keyset pagination helper, condition selecting rows after a key in the given ordering.
+        NULLs sort last ascending and first descending (the postgres default), comparisons
+        with NULL are never true, so nullable columns get explicit IS NULL branches
+        """
+        columns = [field.lstrip('-') for field in ordering]
+        nullable = self._nullable_columns(columns)
+        nulls = tuple(value is None for value in key) if any(nullable) else None
+
+        def compiler():
+            descending = [field.startswith('-') for field in ordering]
+            if nulls is None and (all(descending) or not any(descending)):
+                condition = "({columns}) {op} ({placeholders})".format(
+                    columns=", ".join(columns),
+                    op='<' if descending[0] else '>',
+                    placeholders=", ".join(['%s'] * len(columns))
+                )
+                return condition, tuple(range(len(columns)))
+
+            # mixed directions and NULLs can not use a row comparison
+            alternatives = []
+            key_indexes = []
+            for i, column in enumerate(columns):
+                terms = []
+                indexes = []
+                for j, prev in enumerate(columns[:i]):
+                    if nulls and nulls[j]:
+                        terms.append(f"{prev} IS NULL")
+                    else:
+                        terms.append(f"{prev} = %s")
+                        indexes.append(j)
+                if nulls and nulls[i]:
+                    if not descending[i]:
+                        # nothing sorts after NULL ascending
+                        continue
+                    terms.append(f"{column} IS NOT NULL")
+                elif descending[i] or not nullable[i]:
+                    terms.append(f"{column} {'<' if descending[i] else '>'} %s")
+                    indexes.append(i)
+                else:
+                    terms.append(f"({column} > %s OR {column} IS NULL)")
+                    indexes.append(i)
+                alternatives.append(f"({' AND '.join(terms)})")
+                key_indexes.extend(indexes)
+            if not alternatives:
+                return "FALSE", ()
+            return "({alternatives})".format(alternatives=" OR ".join(alternatives)), tuple(key_indexes)
+
+        return statement_cache.get_or_compile((self.model, 'keyset', ordering, nulls), compiler)
+
+    def _check_page_columns(self, columns):
+        """ the sort key columns must be selected so a page key can be read from the last row """
+        if self._iterable_class is FlatValuesListIterable:
+            if tuple(columns) != self.fields[:1]:
+                raise ValueError('values_list(flat=True) can only be paginated on its own column')
+        elif self._iterable_class in (ValuesIterable, ValuesListIterable):
+            missing = [column for column in columns if column not in self.fields]
+            if missing:
+                raise ValueError(
+                    f"values() / values_list() must select the pagination columns, missing {', '.join(missing)}"
+                )
+
+    def _page_key(self, item, columns):
+        """ sort key values of a result row, whatever the iterable class """
+        if isinstance(item, dict):
+            return [item[column] for column in columns]
+        if isinstance(item, tuple):
+            return [item[self.fields.index(column)] for column in columns]
+        if self._iterable_class is FlatValuesListIterable:
+            return [item]
+        return [getattr(item, column) for column in columns]
+
+    def _check_not_sliced(self, method):
+        """ changes after a slice would be compiled inside its LIMIT / OFFSET and change what it selects """
+        if self.query.is_sliced:
+            raise TypeError(f"Cannot call {method}() on a sliced queryset")
+
+    def _order_by(self, *fields):
+        """ order_by without the slice check, for unordered querysets whose row order is undefined anyway """
+        obj = self._chain()
+        obj.query.ordering = fields
+        return obj
 
-    def _format_values(self, sql, *args):
-        """helper for values/ values list sql formatting"""
+    def _limit_one(self):
+        """ copy of queryset limited to a single row """
+        obj = self._chain()
+        obj.query.set_limits(0, 1)
+        return obj
 
-        _, old_sql = sql.split('FROM')
+    # public methods
+    async def aaggregate(self, **aggregates):
+        """ async version of aggregate() """
+        aggregates = tuple(aggregates.items())
+        rows = await self._aexecute_sql(*self.query.compile_aggregate(aggregates))
+        return dict(zip((alias for alias, _ in aggregates), rows[0]))
 
-        SQL = "SELECT {columns} FROM {old_sql};"
-        FINAL_SQL = SQL.format(
-            columns=", ".join(args),
-            old_sql=old_sql
-        )
-        return FINAL_SQL, list(args)
+    def aggregate(self, **aggregates):
+        """
+        compute aggregates over the queryset in one statement, returns a dict by alias
+            Message.objects.where(is_active=True).aggregate(total=Sum('count'), avg=Avg('tries'))
+        """
+        aggregates = tuple(aggregates.items())
+        rows = self._execute_sql(*self.query.compile_aggregate(aggregates))
+        return dict(zip((alias for alias, _ in aggregates), rows[0]))
 
-    def _order_fields(self, sql, *fields):
-        """order by helper"""
+    def annotate(self, **annotations):
+        """
+        add aggregates per group of the selected columns (GROUP BY), eg.
+            Message.objects.values('user_id').annotate(n=Count('id')).order_by('-n')
+        where() on an alias filters the groups (HAVING)
+        """
+        self._check_not_sliced('annotate')
+        obj = self._chain()
+        obj.query.add_annotations(**annotations)
+        return obj
 
-        sql = sql.replace(';', '')
-        SQL = "{orig_sql} ORDER BY {ordered_fields};"
-        ordered_fields = [f"{field[1:]} DESC" if field.startswith('-') else f"{field}" for field in fields]
-        return SQL.format(orig_sql=sql, ordered_fields=", ".join(ordered_fields))
+    async def acount(self):
+        """ async version of count() """
+
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return (await self._aexecute_sql(*self.query.compile('count')))[0][0]
+
+    async def aexists(self):
+        """ async version of exists() """
+
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return bool(await self._aexecute_sql(*self.query.compile('exists')))
+
+    async def afirst(self):
+        """ async version of first() """
+
+        if self._result_cache is not None and self.ordering:
+            return self._result_cache[0] if self._result_cache else None
+        obj = self if self.ordering else self._order_by('id')
+        items = await obj._limit_one().alist()
+        return items[0] if items else None
+
+    async def alist(self):
+        """ evaluate the queryset without blocking the event loop, returns a list of results """
+        await self._afetch_all()
+        return list(self._result_cache)
 
-    # public methods
     def count(self):
-        """ return count of objects that fit query """
+        """ return count of objects that fit query, using SELECT COUNT(*) unless already fetched """
 
-        self._fetch_all()
-        return len(self._result_cache)
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return self._execute_sql(*self.query.compile('count'))[0][0]
+
+    def exists(self):
+        """ return True if the query matches at least one row """
+
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return bool(self._execute_sql(*self.query.compile('exists')))
+
+    def export(self, fileobj, format='csv', header=True):
+        """
+        Stream the queryset's rows into fileobj with COPY (...) TO STDOUT, formatted by
+        the server as 'csv' (with a header row unless header is False) or 'ndjson'
+        (one json object per line). Rows are not held in memory; returns the row count
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {format}, expected one of {', '.join(EXPORT_FORMATS)}")
+        obj = self._chain()
+        obj.query.related = ()
+        select, params = obj.query.compile()
+
+        def compiler():
+            return EXPORT_FORMATS[format].format(select=select.rstrip(';'), header='true' if header else 'false')
+
+        sql = statement_cache.get_or_compile(('export', format, header, select), compiler)
+        with self.model.manager_class._connection() as connection:
+            cursor = connection.cursor()
+            cursor.copy_expert(cursor.mogrify(sql, params), fileobj)
+            return cursor.rowcount
+
+    def first(self):
+        """ return first object by the queryset ordering (id if unordered), or None """
+
+        if self._result_cache is not None and self.ordering:
+            return self._result_cache[0] if self._result_cache else None
+        obj = self if self.ordering else self._order_by('id')
+        for item in obj._limit_one():
+            return item
+        return None
+
+    def iterator(self, chunk_size=2000):
+        """
+        Stream results through a server side cursor, fetching chunk_size rows per
+        round trip. Results are not stored in the queryset cache
+        """
+        iterable = iter(self._iterable_class(self, chunk_size=chunk_size))
+        if self._prefetch_related:
+            return self._iter_prefetched(iterable, chunk_size)
+        return iterable
+
+    def last(self):
+        """ return last object by the queryset ordering (id if unordered), or None """
+
+        if self._result_cache is not None and self.ordering:
+            return self._result_cache[-1] if self._result_cache else None
+        if self.query.is_sliced:
+            items = list(self if self.ordering else self._order_by('id'))
+            return items[-1] if items else None
+        ordering = self.ordering or ('id',)
+        reverse = [field[1:] if field.startswith('-') else f"-{field}" for field in ordering]
+        for item in self.order_by(*reverse)._limit_one():
+            return item
+        return None
 
     def order_by(self, *fields):
         """Return a new QuerySet instance with the ordering changed."""
+        self._check_not_sliced('order_by')
+        return self._order_by(*fields)
+
+    def paginate_after(self, last_key=None, page_size=50):
+        """
+        Keyset (seek) pagination over the queryset ordering with id as tie breaker.
+        last_key is None for the first page, otherwise the next_token of the previous
+        page (or a tuple of raw sort key values). Returns a Page
+        """
+        ordering = list(self.ordering) or ['id']
+        if 'id' not in [field.lstrip('-') for field in ordering]:
+            ordering.append('-id' if ordering[-1].startswith('-') else 'id')
+        ordering = tuple(ordering)
+        columns = [field.lstrip('-') for field in ordering]
+        self._check_page_columns(columns)
+
+        obj = self.order_by(*ordering)
+        if last_key is not None:
+            key = decode_page_token(last_key) if isinstance(last_key, str) else list(last_key)
+            if len(key) != len(ordering):
+                raise ValueError(f"Page key needs {len(ordering)} values, got {len(key)}")
+            condition, key_indexes = self._keyset_condition(ordering, key)
+            obj.query.add_condition(condition, [key[i] for i in key_indexes])
+
+        items = list(obj[:page_size + 1])
+        next_token = None
+        if len(items) > page_size:
+            items = items[:page_size]
+            next_token = encode_page_token(self._page_key(items[-1], columns))
+        return Page(items, next_token)
+
+    def prefetch_related(self, *names):
+        """
+        load foreign keys or reverse relations (eg. 'message_set') with one extra
+        query per relation once the queryset is evaluated
+        """
+        meta = self.model._meta
+        for name in names:
+            if name not in meta.relations and name not in meta.reverse_relations:
+                raise InvalidRelation(f"'{name}' is not a relation on {self.model.__name__}")
+        obj = self._chain()
+        obj._prefetch_related = self._prefetch_related + tuple(n for n in names if n not in self._prefetch_related)
+        return obj
+
+    def select_related(self, *fields):
+        """
+        load the given foreign keys with a LEFT JOIN in the same query.
+        ignored for values() / values_list() querysets, which return no instances
+        """
+        self._check_not_sliced('select_related')
         obj = self._chain()
-        obj.sql = self._order_fields(obj.sql, *fields)
+        obj.query.add_related(*fields)
+        if self._iterable_class is not ModelIterable:
+            obj.query.related = ()
         return obj
 
+    def to_columns(self, chunk_size=10000):
+        """
+        Return {column: numpy array} for the selected columns, fetched chunk_size rows
+        at a time from a server side cursor. Nullable fields give masked arrays and
+        DateTimeFields datetime64[us] arrays in UTC. Requires numpy
+        """
+        specs = column_specs(self.model, self.query.columns, self.query.annotations)
+        obj = self._chain()
+        # selected under the column name, so GROUP BY still uses the column and ORDER BY the expression
+        obj.query.expressions = tuple(
+            (spec.name, spec.sql) for spec in specs[:len(self.query.columns)] if spec.sql != spec.name
+        )
+        obj.query.related = ()
+        return rows_to_columns(specs, obj._stream_chunks(chunk_size))
+
     def values(self, *args):
         """ modify iterable to return dict or given values"""
         obj = self._chain()
         obj._iterable_class = ValuesIterable
-        obj.sql, obj.fields = self._format_values(obj.sql, *args)
+        obj.query.columns = args
+        obj.query.related = ()
+        obj._prefetch_related = ()
         return obj
 
     def values_list(self, *args, flat=False):
         """ modify iterable to return tuples or individual values"""
         obj = self._chain()
         obj._iterable_class = ValuesListIterable if flat is False else FlatValuesListIterable
-        obj.sql, obj.fields = self._format_values(obj.sql, *args)
+        obj.query.columns = args
+        obj.query.related = ()
+        obj._prefetch_related = ()
         return obj
 
     def where(self, **kwargs):
-        """ modify sql appropriately with 'where' clause """
+        """ add conditions to the query's 'where' clause """
+        self._check_not_sliced('where')
         obj = self._chain()
-        obj.sql, obj.params = self._filter_fields(obj.sql, **kwargs)
+        obj.query.add_filter(**kwargs)
         return obj
 
 
-class ModelIterable():
-    """default  iterable for queryset"""
-    def __init__(self, queryset):
+class BaseIterable():
+    """
+    shared setup for queryset iterables. rows are fetched through the queryset
+    unless already fetched ones are handed in (eg. by the async api)
+    """
+    def __init__(self, queryset, chunk_size=None, rows=None):
         self.queryset = queryset
+        self.chunk_size = chunk_size
+        self.rows = rows
+
+    def _rows(self):
+        if self.rows is not None:
+            return self.rows
+        return self.queryset._execute(self.chunk_size)
+
+
+class ModelIterable(BaseIterable):
+    """default  iterable for queryset"""
 
     def __iter__(self):
-        self.queryset.cursor.execute(self.queryset.sql, self.queryset.params)
-        for row in self.queryset.cursor.fetchall():
-            instance = self.queryset.model()
-            for field, value in zip(self.queryset.fields, row):
-                setattr(instance, field, value)
+        from_db = self.queryset.model.from_db
+        fields = self.queryset.fields
+        related = self.queryset.query.related_layout()
+        session = current_session()
+        if session is None and not related:
+            for row in self._rows():
+                yield from_db(fields, row)
+            return
+
+        model = self.queryset.model
+        id_index = fields.index('id') if session is not None and 'id' in fields else None
+        for row in self._rows():
+            instance = session.get(model, row[id_index]) if id_index is not None else None
+            if instance is None:
+                instance = from_db(fields, row)
+                if id_index is not None:
+                    session.add(instance)
+            for name, rel_model, start, end in related:
+                rel_instance = None
+                if row[start] is not None:
+                    rel_instance = session.get(rel_model, row[start]) if session is not None else None
+                    if rel_instance is None:
+                        rel_instance = rel_model.from_db(rel_model._meta.all_columns, row[start:end])
+                        if session is not None:
+                            session.add(rel_instance)
+                setattr(instance, name, rel_instance)
             yield instance
 
 
-class ValuesIterable():
+class ValuesIterable(BaseIterable):
     """queryset iterable that returns dict of stated values"""
-    def __init__(self, queryset):
-        self.queryset = queryset
-
     def __iter__(self):
-        self.queryset.cursor.execute(self.queryset.sql, self.queryset.params)
         fields = self.queryset.fields
         indexes = range(len(fields))
-        for row in self.queryset.cursor.fetchall():
+        for row in self._rows():
             yield {fields[i]: row[i] for i in indexes}
 
 
-class ValuesListIterable():
+class ValuesListIterable(BaseIterable):
     """queryset iterable that returns tuple of provided values"""
 
-    def __init__(self, queryset):
-        self.queryset = queryset
-
     def __iter__(self):
-        self.queryset.cursor.execute(self.queryset.sql, self.queryset.params)
-        for row in self.queryset.cursor.fetchall():
+        for row in self._rows():
             yield row
 
 
-class FlatValuesListIterable():
+class FlatValuesListIterable(BaseIterable):
     """
     Iterable returned by QuerySet.values_list(flat=True) that yields single
     values.
     """
-    def __init__(self, queryset):
-        self.queryset = queryset
-
     def __iter__(self):
-        self.queryset.cursor.execute(self.queryset.sql, self.queryset.params)
-        for row in self.queryset.cursor.fetchall():
+        for row in self._rows():
             yield row[0]
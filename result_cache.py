@@ -0,0 +1,178 @@
+from collections import OrderedDict
+import hashlib
+import sys
+import threading
+import time
+from uuid import uuid4
+
+
+class CacheBackend():
+    """
+    Storage used by ResultCache. Keys are strings and values picklable python
+    objects, so the interface can be implemented on top of an external store
+    (eg. memcached or redis) as well as in process
+    """
+
+    def get(self, key):
+        """ stored value, or None when missing or expired """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """ store value, expiring after ttl seconds (never when None) """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+def _approximate_size(value):
+    """ rough memory use of a list of rows """
+    size = sys.getsizeof(value)
+    if isinstance(value, list):
+        for row in value:
+            size += sys.getsizeof(row)
+            if isinstance(row, tuple):
+                size += sum(sys.getsizeof(item) for item in row)
+    return size
+
+
+class LocalCache(CacheBackend):
+    """
+    In process LRU backend bounded by number of entries and approximate memory use
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _pop(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value, _ = self._data[key]
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.monotonic():
+                self._pop(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        size = _approximate_size(value)
+        if size > self.max_bytes:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (expires, value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._pop(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
+
+
+class ResultCache():
+    """
+    Optional cache of query results keyed by compiled sql and params.
+    Every table has a version token stored in the backend and part of each key,
+    writing to a table replaces its token so older results are never read again
+    (and age out of the backend). ttl is the default lifetime in seconds, ttls
+    overrides it per model; a ttl of 0 disables caching for that model
+    """
+
+    def __init__(self, backend=None, ttl=300, ttls=None):
+        self.backend = backend if backend is not None else LocalCache()
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def _version(self, table):
+        key = f"orm:version:{table}"
+        version = self.backend.get(key)
+        if version is None:
+            version = uuid4().hex
+            self.backend.set(key, version)
+        return version
+
+    def ttl_for(self, model):
+        return self.ttls.get(model, self.ttl)
+
+    def key(self, tables, sql, params):
+        """ cache key for a statement reading the given tables """
+        versions = ":".join(self._version(table) for table in tables)
+        digest = hashlib.sha1(repr((sql, tuple(params or ()))).encode()).hexdigest()
+        return f"orm:rows:{versions}:{digest}"
+
+    def get(self, key):
+        rows = self.backend.get(key)
+        if rows is None:
+            self._count(misses=1)
+        else:
+            self._count(hits=1)
+        return rows
+
+    def set(self, model, key, rows):
+        self.backend.set(key, rows, self.ttl_for(model))
+
+    def invalidate(self, *tables):
+        """ drop cached results reading any of the tables """
+        for table in tables:
+            self.backend.set(f"orm:version:{table}", uuid4().hex)
+        self._count(invalidations=len(tables))
+
+    def clear(self):
+        self.backend.clear()
+
+    def info(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
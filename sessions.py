@@ -0,0 +1,60 @@
+import contextvars
+
+
+_current_session = contextvars.ContextVar('orm_session', default=None)
+
+
+def current_session():
+    """ the Session active in this thread / task, or None """
+    return _current_session.get()
+
+
+class Session():
+    """
+    Opt-in unit of work scope holding an identity map keyed by (model, id).
+    While a session is active, repeated loads of the same row return the same
+    instance and get(id=...) is served from memory. The map is emptied when the
+    session ends
+
+        with Session():
+            user = User.objects.get(id=1)
+            assert User.objects.get(id=1) is user
+    """
+
+    def __init__(self):
+        self.identity_map = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_session.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clear()
+        _current_session.reset(self._token)
+        self._token = None
+
+    def __contains__(self, instance):
+        return self.identity_map.get((type(instance), instance.id)) is instance
+
+    def __len__(self):
+        return len(self.identity_map)
+
+    def add(self, instance):
+        """ track instance, returning the already tracked instance for the same row if any """
+        if instance.id is None:
+            return instance
+        return self.identity_map.setdefault((type(instance), instance.id), instance)
+
+    def clear(self):
+        self.identity_map.clear()
+
+    def discard(self, instance):
+        self.identity_map.pop((type(instance), instance.id), None)
+
+    def get(self, model, id):
+        return self.identity_map.get((model, id))
+
+    def refresh(self, instance):
+        """ reload instance values from the database """
+        return type(instance).objects.refresh(instance)
@@ -4,7 +4,17 @@ DB_SETTINGS = {
     'DB_HOST': 'localhost',
     'DB_NAME': 'orm_db',
     'DB_USER': 'orm_user',
-    'DB_PASS': 'orm_password'
+    'DB_PASS': 'orm_password',
+    # connection pool (optional)
+    'POOL_MIN_SIZE': 1,
+    'POOL_MAX_SIZE': 10,
+    'POOL_TIMEOUT': 30.0,
+    'POOL_MAX_LIFETIME': 3600.0,
+    'POOL_PING': False,
+    # server side prepared statements (optional)
+    'PREPARED_STATEMENTS': False,
+    'PREPARED_MAXSIZE': 100,
+    'PREPARE_THRESHOLD': 5,
 }
 
 
@@ -0,0 +1,193 @@
+from collections import OrderedDict
+import itertools
+import threading
+import weakref
+
+
+class StatementCache():
+    """
+    Bounded LRU cache of compiled sql statements.
+    Keys describe the shape of a query (model, operation, lookup names...),
+    values are whatever the compiler produced for that shape
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_compile(self, key, compiler):
+        """ return cached statement for key, calling compiler() on a miss """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value
+
+        value = compiler()
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """ hit/miss counters used for sizing the cache """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+statement_cache = StatementCache()
+
+
+def to_prepared_sql(sql):
+    """ replace %s placeholders with $1, $2... and drop the trailing semicolon for PREPARE """
+    parts = sql.rstrip().rstrip(';').split('%%')
+    count = 0
+    for i, part in enumerate(parts):
+        pieces = part.split('%s')
+        text = pieces[0]
+        for piece in pieces[1:]:
+            count += 1
+            text = f"{text}${count}{piece}"
+        parts[i] = text
+    return '%'.join(parts), count
+
+
+class ConnectionStatements():
+    """
+    Statements prepared on one connection, bounded LRU of sql -> prepared name.
+    Usage counts of not yet prepared statements are bounded the same way
+    """
+
+    def __init__(self, prefix, version):
+        self.prefix = prefix
+        self.version = version
+        self.prepared = OrderedDict()
+        self.counts = OrderedDict()
+        self._next_id = 0
+
+    def next_name(self):
+        self._next_id += 1
+        return f"{self.prefix}_{self._next_id}"
+
+
+# prepared statements outlive a cache on its pooled connections, so every cache
+# names its statements differently
+_cache_ids = itertools.count(1)
+
+
+class PreparedStatementCache():
+    """
+    Opt-in server side prepared statements.
+    A statement executed threshold times on a connection is PREPAREd there and then
+    run with EXECUTE, skipping parse and planning. Each connection keeps at most
+    maxsize statements, the least recently used one is DEALLOCATEd to make room.
+    invalidate() (called after schema changes) makes every connection drop its
+    statements before its next query
+    """
+
+    def __init__(self, maxsize=100, threshold=5):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.prefix = f"orm_stmt_{next(_cache_ids)}"
+        self.version = 0
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prepares = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _registry(self, connection):
+        with self._lock:
+            registry = self._connections.get(connection)
+            if registry is None:
+                registry = self._connections[connection] = ConnectionStatements(self.prefix, self.version)
+            return registry
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def execute(self, cursor, sql, params=None):
+        """ run sql on cursor, through a prepared statement once it is used often enough """
+        registry = self._registry(cursor.connection)
+        if registry.version != self.version:
+            if registry.prepared:
+                cursor.execute("DEALLOCATE ALL;")
+            registry.prepared.clear()
+            registry.counts.clear()
+            registry.version = self.version
+
+        entry = registry.prepared.get(sql)
+        if entry is None:
+            uses = registry.counts.pop(sql, 0) + 1
+            if uses < self.threshold:
+                registry.counts[sql] = uses
+                if len(registry.counts) > self.maxsize:
+                    registry.counts.popitem(last=False)
+                self._count(misses=1)
+                cursor.execute(sql, params)
+                return
+            prepared_sql, num_params = to_prepared_sql(sql)
+            entry = (registry.next_name(), num_params)
+            if len(registry.prepared) >= self.maxsize:
+                _, (old_name, _) = registry.prepared.popitem(last=False)
+                cursor.execute(f"DEALLOCATE {old_name};")
+                self._count(evictions=1)
+            cursor.execute(f"PREPARE {entry[0]} AS {prepared_sql};")
+            registry.prepared[sql] = entry
+            self._count(prepares=1)
+        else:
+            registry.prepared.move_to_end(sql)
+            self._count(hits=1)
+
+        name, num_params = entry
+        if num_params:
+            cursor.execute(f"EXECUTE {name}({', '.join(['%s'] * num_params)});", params)
+        else:
+            cursor.execute(f"EXECUTE {name};")
+
+    def invalidate(self):
+        """ forget prepared statements on every connection, eg. after a schema change """
+        with self._lock:
+            self.version += 1
+            self.invalidations += 1
+
+    def info(self):
+        """ counters for prepared statement use, hit_rate is the share of executions using one """
+        with self._lock:
+            executions = self.hits + self.prepares + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'prepares': self.prepares,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / executions if executions else 0.0,
+                'connections': len(self._connections),
+                'maxsize': self.maxsize,
+                'threshold': self.threshold,
+            }
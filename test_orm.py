@@ -1,9 +1,28 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import csv
 from datetime import datetime, timedelta, timezone
+from functools import partial
+import io
+import json
+import threading
 
+import psycopg2
 import pytest
 
-from exceptions import ModelNotFound, MultipleObjectsReturned
-from querysets import Queryset
+from aggregates import Avg, Count, Max, Sum
+from base_orm import BaseManager, Model, atomic
+from copy_streams import CopyInStream
+from exceptions import InvalidLookup, InvalidRelation, ModelNotFound, MultipleObjectsReturned, PoolTimeout
+import fields
+from indexes import Index
+from pool import ConnectionPool, ping_connection
+from querysets import Queryset, decode_page_token
+from result_cache import LocalCache, ResultCache
+from sessions import Session, current_session
+from settings import TEST_DB_SETTINGS
+from statements import PreparedStatementCache, StatementCache, statement_cache, to_prepared_sql
+from transactions import current_transaction
 
 
 def test_create_models(test_client_db, cleanup):
@@ -840,3 +859,963 @@ def test_values_list_chain(test_client_db, cleanup):
 
     msgs = Message.objects.values_list('id', flat=True).where(count=77).order_by('-id')
     assert [msg for msg in msgs] == [2, 1]
+
+
+def test_model_meta(test_client_db, cleanup):
+    _, Message, User = test_client_db
+    assert Message._meta.table_name == 'messages_message'
+    assert Message._meta.all_columns[0] == 'id'
+    assert 'user_id' in Message._meta.columns
+    assert Message._meta.fk_columns == ('user_id',)
+    assert Message._meta.defaults['is_active'] is True
+    sql, cols = Message._get_select_all_sql()
+    assert cols == list(Message._meta.all_columns)
+    assert 'user' not in User._meta.columns
+
+
+def test_statement_cache(test_client_db, cleanup):
+    _, Message, *rest = test_client_db
+    Message.objects.create(content='cached', count=3)
+    statement_cache.clear()
+    Message.objects.get(content='cached', count=3)
+    assert statement_cache.info()['misses'] == 1
+    msg = Message.objects.get(count=3, content='cached')
+    assert statement_cache.info()['hits'] == 1
+    assert msg.content == 'cached'
+
+    small = StatementCache(maxsize=2)
+    for key in ('a', 'b', 'c'):
+        small.get_or_compile(key, lambda: key.upper())
+    assert len(small) == 2
+    assert small.get_or_compile('c', lambda: None) == 'C'
+    assert small.info() == {'hits': 1, 'misses': 3, 'size': 2, 'maxsize': 2}
+
+
+def test_bulk_create(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    jobs = [Job(data=f'job {i}', count=i, is_active=True) for i in range(5)]
+    created = Job.objects.bulk_create(jobs, batch_size=2)
+    assert [job.id for job in created] == [1, 2, 3, 4, 5]
+    assert Job.objects.all().count() == 5
+    job = Job.objects.get(id=4)
+    assert job.data == 'job 3'
+    assert job.count == 3
+    assert Job.objects.bulk_create([]) == []
+
+
+def test_copy_in(test_client_db, cleanup):
+    _, Message, User = test_client_db
+    user = User.objects.create(email='copy@email.com', first_name='copy', last_name='in', is_active=True)
+    created = datetime(2022, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+    def rows():
+        yield Message(content='tab\there', body='line\nbreak \\ slash', count=1, tries=1.25,
+                      is_active=False, date_created=created, user_id=user.id)
+        yield {'content': 'from dict', 'count': None}
+
+    assert Message.objects.copy_in(rows()) == 2
+    first = Message.objects.get(id=1)
+    assert first.content == 'tab\there'
+    assert first.body == 'line\nbreak \\ slash'
+    assert first.tries == 1.25
+    assert first.is_active is False
+    assert first.date_created == created
+    assert first.user_id == user.id
+    second = Message.objects.get(content='from dict')
+    assert second.count is None
+    assert second.body is None
+    assert second.is_active is True
+
+
+def test_copy_in_stream_reads_lazily():
+    consumed = []
+
+    def lines():
+        for i in range(1000):
+            consumed.append(i)
+            yield f'{i}\n'
+
+    stream = CopyInStream(lines())
+    assert stream.read(4) == '0\n1\n'
+    assert len(consumed) < 10
+    assert stream.read().endswith('999\n')
+    assert stream.read(10) == ''
+
+
+def test_connection_pool(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    connect = partial(
+        psycopg2.connect,
+        dbname=TEST_DB_SETTINGS.get('DB_NAME'),
+        user=TEST_DB_SETTINGS.get('DB_USER'),
+        password=TEST_DB_SETTINGS.get('DB_PASS'),
+        host=TEST_DB_SETTINGS.get('DB_HOST')
+    )
+    pool = ConnectionPool(connect, min_size=1, max_size=2, timeout=0.1, health_check=ping_connection)
+    first = pool.getconn()
+    second = pool.getconn()
+    assert pool.stats()['in_use'] == 2
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    # failed transaction is rolled back when returned
+    with pytest.raises(psycopg2.Error):
+        first.cursor().execute("SELECT * FROM missing_table;")
+    pool.putconn(first)
+    with pool.connection() as connection:
+        assert connection is first
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1;")
+        assert cursor.fetchone() == (1,)
+    pool.putconn(second)
+    stats = pool.stats()
+    assert stats['in_use'] == 0
+    assert stats['idle'] == 2
+    assert stats['checkouts'] == 3
+    pool.closeall()
+
+
+def test_pool_io_outside_lock(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    connect = partial(
+        psycopg2.connect,
+        dbname=TEST_DB_SETTINGS.get('DB_NAME'),
+        user=TEST_DB_SETTINGS.get('DB_USER'),
+        password=TEST_DB_SETTINGS.get('DB_PASS'),
+        host=TEST_DB_SETTINGS.get('DB_HOST')
+    )
+    pool_ready = threading.Event()
+    connecting = threading.Event()
+    release = threading.Event()
+
+    def slow_connect():
+        if pool_ready.is_set():
+            connecting.set()
+            release.wait(5)
+        return connect()
+
+    pool = ConnectionPool(slow_connect, min_size=1, max_size=3, timeout=5)
+    pool_ready.set()
+    first = pool.getconn()
+    first.cursor().execute("SELECT 1;")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        growing = executor.submit(pool.getconn)
+        assert connecting.wait(5)
+
+        def reuse():
+            pool.putconn(first)
+            return pool.getconn()
+
+        # returning (with its rollback) and borrowing an idle connection does not wait for the connect
+        reused = executor.submit(reuse)
+        assert reused.result(timeout=2) is first
+        assert pool.stats()['in_use'] == 1
+        release.set()
+        second = growing.result(timeout=5)
+    assert second is not first
+    assert pool.stats()['in_use'] == 2
+    pool.putconn(first)
+    pool.putconn(second)
+    assert pool.stats()['idle'] == 2
+    pool.closeall()
+
+
+def test_pool_threads(test_client_db, cleanup):
+    Job, *rest = test_client_db
+
+    def work(i):
+        Job.objects.create(data=f'thread {i}', is_active=True)
+        return Job.objects.where(data=f'thread {i}').count()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(work, range(40)))
+    assert results == [1] * 40
+    assert Job.objects.all().count() == 40
+    assert Job.objects.stats()['in_use'] == 0
+
+
+def test_iterator(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    Job.objects.bulk_create([Job(data=f'job {i}', count=i, is_active=True) for i in range(25)])
+    jobs = Job.objects.all().order_by('id')
+    ids = [job.id for job in jobs.iterator(chunk_size=10)]
+    assert ids == list(range(1, 26))
+    assert jobs._result_cache is None
+
+    counts = Job.objects.where(is_active=True).values_list('count', flat=True).order_by('-id')
+    assert list(counts.iterator(chunk_size=7)) == list(range(24, -1, -1))
+    values = Job.objects.values('id', 'data').order_by('id').iterator(chunk_size=3)
+    assert next(values) == {'id': 1, 'data': 'job 0'}
+    values.close()
+    assert Job.objects.stats()['in_use'] == 0
+
+
+def test_count_exists_first_last(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    assert Job.objects.all().exists() is False
+    assert Job.objects.all().first() is None
+    assert Job.objects.all().last() is None
+    Job.objects.bulk_create([Job(data=f'job {i}', count=i % 3, is_active=True) for i in range(6)])
+
+    jobs = Job.objects.where(count=1)
+    assert jobs.count() == 2
+    assert jobs._result_cache is None
+    assert jobs.exists() is True
+    assert Job.objects.where(count=5).exists() is False
+    assert jobs.first().id == 2
+    assert jobs.last().id == 5
+    ordered = Job.objects.all().order_by('-count', 'id')
+    assert ordered.first().id == 3
+    assert ordered.last().id == 4
+    assert Job.objects.values_list('data', flat=True).order_by('-id').first() == 'job 5'
+
+    assert len(ordered) == 6
+    assert ordered.count() == 6
+    assert ordered.order_by('id').first().id == 1
+
+
+def test_slicing(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    Job.objects.bulk_create([Job(data=f'job {i}', count=i, is_active=True) for i in range(30)])
+    jobs = Job.objects.all().order_by('id')
+
+    page = jobs[10:20]
+    assert type(page) == Queryset
+    assert page._result_cache is None
+    assert page.sql.endswith('LIMIT 10 OFFSET 10;')
+    assert [job.id for job in page] == list(range(11, 21))
+    assert [job.id for job in page[2:4]] == [13, 14]
+    assert page.count() == 10
+    assert page.first().id == 11
+    assert page.last().id == 20
+
+    assert jobs[0].id == 1
+    assert jobs[29].id == 30
+    with pytest.raises(IndexError):
+        jobs[30]
+    assert jobs[-1].id == 30
+    assert list(Job.objects.values_list('count', flat=True).order_by('-id')[:3]) == [29, 28, 27]
+    assert repr(jobs).endswith("'...(remaining elements truncated)...']>")
+
+    # filtering or reordering a slice would change which rows it selects
+    Message = rest[0]
+    unevaluated = Job.objects.all().order_by('id')
+    with pytest.raises(TypeError):
+        unevaluated[:5].where(count=1)
+    with pytest.raises(TypeError):
+        unevaluated[:5].order_by('-id')
+    with pytest.raises(TypeError):
+        unevaluated[:5].annotate(n=Count('id'))
+    with pytest.raises(TypeError):
+        Message.objects.all()[:5].select_related('user')
+    assert list(unevaluated[:5].values_list('id', flat=True)) == [1, 2, 3, 4, 5]
+    assert Job.objects.all()[:3].first().id == 1
+    assert Job.objects.all()[:3].last().id == 3
+
+
+def test_paginate_after(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    Job.objects.bulk_create([
+        Job(data=f'job {i}', count=i % 4, is_active=i % 5 != 0, date_created=start + timedelta(hours=i // 2))
+        for i in range(20)
+    ])
+
+    def all_pages(queryset, page_size):
+        ids, token = [], None
+        while True:
+            page = queryset.paginate_after(token, page_size)
+            ids.extend(job.id if hasattr(job, 'id') else job['id'] for job in page)
+            if not page.has_next:
+                return ids
+            token = page.next_token
+
+    assert all_pages(Job.objects.all(), 6) == list(range(1, 21))
+    ordered = Job.objects.all().order_by('-date_created')
+    assert all_pages(ordered, 3) == [job.id for job in ordered.order_by('-date_created', '-id')]
+    mixed = Job.objects.where(is_active=True).order_by('count', '-date_created')
+    assert all_pages(mixed, 4) == [job.id for job in mixed.order_by('count', '-date_created', '-id')]
+    assert len(all_pages(mixed, 4)) == 16
+    values = Job.objects.values('id', 'count').order_by('-count')
+    assert all_pages(values, 5) == [job['id'] for job in values.order_by('-count', '-id')]
+
+    page = Job.objects.all().order_by('-date_created').paginate_after(None, 2)
+    assert [job.id for job in page] == [20, 19]
+    assert decode_page_token(page.next_token) == [start + timedelta(hours=9), 19]
+    assert [job.id for job in Job.objects.all().paginate_after((5,), 2)] == [6, 7]
+
+    with pytest.raises(ValueError):
+        Job.objects.values('data').paginate_after(None, 1)
+    with pytest.raises(ValueError):
+        Job.objects.values_list('data', 'count').order_by('count').paginate_after(None, 1)
+    with pytest.raises(ValueError):
+        Job.objects.values_list('data', flat=True).paginate_after(None, 1)
+
+
+def test_paginate_after_nulls(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    Job.objects.bulk_create([
+        Job(data=f'job {i}', count=None if i % 3 == 0 else i % 2, is_active=True,
+            date_created=None if i % 5 in (1, 3) else start + timedelta(hours=i // 2))
+        for i in range(10)
+    ])
+    assert Job.objects.where(date_created__isnull=True).count() == 4
+
+    def all_pages(queryset, page_size):
+        ids, token = [], None
+        while True:
+            page = queryset.paginate_after(token, page_size)
+            ids.extend(job.id if hasattr(job, 'id') else job['id'] for job in page)
+            if not page.has_next:
+                return ids
+            token = page.next_token
+
+    orderings = [
+        ('date_created',), ('-date_created',), ('count', 'date_created'), ('-count', 'date_created'),
+        ('count', '-date_created'), ('-count', '-date_created', '-id'),
+    ]
+    for ordering in orderings:
+        queryset = Job.objects.all().order_by(*ordering)
+        tie_breaker = ('-id',) if ordering[-1].startswith('-') else ('id',)
+        expected = [job.id for job in queryset.order_by(*(ordering + tie_breaker))]
+        for page_size in (1, 3, 4):
+            assert all_pages(queryset, page_size) == expected, (ordering, page_size)
+
+    values = Job.objects.values('id', 'date_created').order_by('-date_created')
+    assert all_pages(values, 3) == [job['id'] for job in values.order_by('-date_created', '-id')]
+
+
+def test_query_chaining(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    Job.objects.bulk_create([Job(data=f'job {i % 2}', count=i % 3, is_active=True) for i in range(12)])
+
+    jobs = Job.objects.all().order_by('-id').where(data='job 1').values_list('id', flat=True).where(count=2)
+    assert jobs.sql == (
+        "SELECT id FROM jobs_job WHERE data=%s AND count=%s ORDER BY id DESC;"
+    )
+    assert list(jobs) == [12, 6]
+    base = Job.objects.where(count=0)
+    narrowed = base.where(data='job 0')
+    assert base.query.conditions == ('count=%s',)
+    assert narrowed.count() == 2
+    assert base.count() == 4
+
+
+def test_lookups(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    Job.objects.bulk_create([
+        Job(data=f'job_{i}' if i % 2 else f'task {i}', count=i if i < 8 else None, tries=i / 2, is_active=True)
+        for i in range(10)
+    ])
+
+    ids = Job.objects.where(id__in=[2, 4, 9, 100]).values_list('id', flat=True).order_by('id')
+    assert list(ids) == [2, 4, 9]
+    assert Job.objects.where(id__in=[]).count() == 0
+    assert Job.objects.where(id__in=[1, 2]).sql == Job.objects.where(id__in=list(range(500))).sql
+    assert Job.objects.where(count__gt=5).count() == 2
+    assert Job.objects.where(count__gte=5, count__lt=7).count() == 2
+    assert Job.objects.where(count__lte=1).count() == 2
+    assert Job.objects.where(tries__range=(1.0, 2.0)).count() == 3
+    assert Job.objects.where(count__isnull=True).count() == 2
+    assert Job.objects.where(count__isnull=False).count() == 8
+    assert Job.objects.where(data__startswith='job_').count() == 5
+    assert Job.objects.where(data__startswith='jo%').count() == 0
+    assert Job.objects.get(data__startswith='task', count__gt=5).id == 7
+    with pytest.raises(InvalidLookup):
+        Job.objects.where(count__near=3)
+
+
+def test_select_related(test_client_db, cleanup):
+    _, Message, User = test_client_db
+    users = User.objects.bulk_create([
+        User(email=f'user{i}@email.com', first_name='first', last_name='last', is_active=i == 0)
+        for i in range(2)
+    ])
+    Message.objects.bulk_create([
+        Message(content=f'msg {i}', is_active=True, user_id=users[i % 2].id if i < 4 else None)
+        for i in range(5)
+    ])
+
+    msgs = Message.objects.where(is_active=True).select_related('user').order_by('-id')
+    assert msgs.sql.count('LEFT JOIN users_user') == 1
+    msgs = list(msgs)
+    assert [msg.id for msg in msgs] == [5, 4, 3, 2, 1]
+    assert msgs[0].user is None
+    assert type(msgs[1].user) == User
+    assert msgs[1].user.id == users[1].id
+    assert msgs[1].user.email == 'user1@email.com'
+    assert msgs[4].user.is_active is True
+    assert msgs[4].user_id == msgs[4].user.id
+
+    msg = Message.objects.all().select_related('user').order_by('id')[1]
+    assert msg.user.email == 'user1@email.com'
+    assert list(Message.objects.all().select_related('user').values_list('id', flat=True).order_by('id')[:2]) == [1, 2]
+    first_content = Message.objects.get(id=1).content
+    assert list(Message.objects.values_list('id', 'content').select_related('user').order_by('id')[:1]) == [
+        (1, first_content)
+    ]
+    assert list(Message.objects.values('id').select_related('user').order_by('id')[:2]) == [{'id': 1}, {'id': 2}]
+    with pytest.raises(InvalidRelation):
+        Message.objects.all().select_related('content')
+    with pytest.raises(InvalidRelation):
+        Message.objects.values('id').select_related('content')
+
+
+def test_prefetch_related(test_client_db, cleanup, monkeypatch):
+    _, Message, User = test_client_db
+    users = User.objects.bulk_create([
+        User(email=f'user{i}@email.com', first_name='first', last_name='last', is_active=i != 2)
+        for i in range(3)
+    ])
+    Message.objects.bulk_create([
+        Message(content=f'msg {i}', is_active=True, user_id=users[i % 2].id if i < 5 else None)
+        for i in range(6)
+    ])
+
+    executed = []
+    original = Queryset._execute
+
+    def counting_execute(self, chunk_size=None):
+        executed.append(self.model)
+        return original(self, chunk_size)
+
+    monkeypatch.setattr(Queryset, '_execute', counting_execute)
+
+    users = list(User.objects.where(is_active=True).prefetch_related('message_set').order_by('id'))
+    assert executed == [User, Message]
+    assert [msg.id for msg in users[0].message_set] == [1, 3, 5]
+    assert [msg.id for msg in users[1].message_set] == [2, 4]
+
+    executed.clear()
+    msgs = list(Message.objects.all().prefetch_related('user').order_by('id'))
+    assert executed == [Message, User]
+    assert msgs[0].user.email == 'user0@email.com'
+    assert msgs[5].user is None
+
+    executed.clear()
+    streamed = list(User.objects.all().prefetch_related('message_set').order_by('id').iterator(chunk_size=2))
+    assert executed == [User, Message, Message]
+    assert [len(user.message_set) for user in streamed] == [3, 2, 0]
+    with pytest.raises(InvalidRelation):
+        User.objects.all().prefetch_related('email')
+
+
+def test_session_identity_map(test_client_db, cleanup, monkeypatch):
+    _, Message, User = test_client_db
+    user = User.objects.create(email='map@email.com', first_name='first', last_name='last', is_active=True)
+    Message.objects.create(content='msg', user_id=user.id)
+    assert User.objects.get(id=user.id) is not User.objects.get(id=user.id)
+
+    with Session() as session:
+        first = User.objects.get(id=user.id)
+
+        def fail(*args, **kwargs):
+            raise AssertionError('identity map should serve get(id=...)')
+
+        monkeypatch.setattr(BaseManager, '_get_row', fail)
+        assert User.objects.get(id=user.id) is first
+        monkeypatch.undo()
+
+        assert User.objects.get(email='map@email.com') is first
+        assert User.objects.where(is_active=True)[0] is first
+        msg = Message.objects.all().select_related('user')[0]
+        assert msg.user is first
+        assert first in session
+
+        first.first_name = 'changed locally'
+        assert User.objects.all()[0].first_name == 'changed locally'
+        first.refresh()
+        assert first.first_name == 'first'
+
+        msg.delete()
+        assert session.get(Message, msg.id) is None
+        new_user = User(email='new@email.com', first_name='new', last_name='user', is_active=True)
+        new_user.save()
+        assert User.objects.get(id=new_user.id) is new_user
+    assert len(session) == 0
+    assert current_session() is None
+
+
+def test_slot_based_instances(test_client_db, cleanup):
+    _, Message, User = test_client_db
+    assert 'content' in Message.__slots__
+    assert 'user' in Message.__slots__
+    msg = Message(content='slots')
+    assert msg.id is None
+    assert msg.is_active is True
+    assert msg.count is None
+    assert msg.__dict__ == {}
+
+    user = User.objects.create(email='slots@email.com', first_name='first', last_name='last', is_active=True)
+    msg = Message(content='with user', user=user)
+    assert msg.user_id == user.id
+    msg.save()
+    assert Message.objects.get(id=msg.id).user_id == user.id
+
+
+def test_from_db(test_client_db, cleanup):
+    Job, *rest = test_client_db
+    columns = ('id', 'data', 'count')
+    job = Job.from_db(columns, (7, 'from row', None))
+    assert type(job) == Job
+    assert (job.id, job.data, job.count) == (7, 'from row', None)
+    assert Job._meta.row_setters[columns]
+    with pytest.raises(AttributeError):
+        job.is_active
+    extra = Job.from_db(('id', 'total'), (1, 10))
+    assert extra.total == 10
+
+    Job.objects.create(data='loaded', is_active=True)
+    loaded = Job.objects.all()[0]
+    assert loaded.data == 'loaded'
+    assert loaded.is_active is True
+
+
+def test_dirty_field_tracking(test_client_db, cleanup, monkeypatch):
+    Job, *rest = test_client_db
+    Job.objects.create(data='original', body='long body', count=1, is_active=True)
+    job = Job.objects.get(id=1)
+    assert job.get_dirty_fields() == []
+
+    # another writer changes a column we do not touch
+    other = Job.objects.get(id=1)
+    other.body = 'changed elsewhere'
+    other.save()
+
+    job.count = 2
+    assert job.get_dirty_fields() == ['count']
+    assert job._get_update_sql(job.get_dirty_fields())[0] == "UPDATE jobs_job SET count = %s WHERE id = %s"
+    job.save()
+    assert job.get_dirty_fields() == []
+    reloaded = Job.objects.get(id=1)
+    assert reloaded.count == 2
+    assert reloaded.body == 'changed elsewhere'
+
+    def fail():
+        raise AssertionError('clean instance should not hit the database')
+
+    monkeypatch.setattr(BaseManager, '_connection', fail)
+    job.save()
+    monkeypatch.undo()
+
+    job.data = 'not saved'
+    job.count = 3
+    job.save(update_fields=['count'])
+    reloaded = Job.objects.get(id=1)
+    assert (reloaded.data, reloaded.count) == ('original', 3)
+    with pytest.raises(ValueError):
+        job.save(update_fields=['missing'])
+
+    new_job = Job(data='new', is_active=False)
+    assert 'data' in new_job.get_dirty_fields()
+    new_job.save()
+    assert new_job.get_dirty_fields() == []
+
+
+def test_atomic(test_client_db, cleanup, test_db_connection):
+    Job, *rest = test_client_db
+
+    def committed_count():
+        cursor = test_db_connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM jobs_job;")
+        count = cursor.fetchone()[0]
+        test_db_connection.commit()
+        return count
+
+    with atomic():
+        Job.objects.create(data='one', is_active=True)
+        job = Job(data='two', is_active=True)
+        job.save()
+        job.count = 5
+        job.save()
+        assert Job.objects.where(count=5).count() == 1
+        assert committed_count() == 0
+    assert committed_count() == 2
+
+    with pytest.raises(RuntimeError):
+        with atomic():
+            Job.objects.create(data='three', is_active=True)
+            raise RuntimeError('rollback')
+    assert committed_count() == 2
+
+    with atomic():
+        Job.objects.create(data='outer', is_active=True)
+        with pytest.raises(psycopg2.Error):
+            with atomic():
+                Job.objects.create(data='inner', is_active=True)
+                Job.objects.create(data=None, is_active=True)
+        Job.objects.get(id=job.id).delete()
+    assert list(Job.objects.values_list('data', flat=True).order_by('id')) == ['one', 'outer']
+    assert current_transaction() is None
+    assert Job.objects.stats()['in_use'] == 0
+
+
+def test_async_api(test_client_db, cleanup):
+    Job, Message, User = test_client_db
+
+    async def main():
+        user = await User.objects.acreate(email='a@example.com', first_name='a', last_name='b', is_active=True)
+        assert (await User.objects.aget(id=user.id)).email == 'a@example.com'
+        await asyncio.gather(*[
+            Message.objects.acreate(content=f"msg {i}", count=i, user_id=user.id) for i in range(5)
+        ])
+
+        queryset = Message.objects.where(count__gte=2).order_by('-count')
+        assert await queryset.acount() == 3
+        assert await queryset.aexists()
+        assert not await Message.objects.where(count=99).aexists()
+        assert [msg.count async for msg in queryset] == [4, 3, 2]
+        assert (await queryset.afirst()).count == 4
+        assert await Message.objects.values_list('count', flat=True).where(count__lt=2).order_by('count').alist() == [0, 1]
+        assert await Message.objects.values_list('count', flat=True).where(count__lt=2).order_by('count').alist() == \
+            list(Message.objects.values_list('count', flat=True).where(count__lt=2).order_by('count'))
+
+        prefetched = await User.objects.where(id=user.id).prefetch_related('message_set').alist()
+        assert len(prefetched[0].message_set) == 5
+
+        msg = await Message.objects.aget(count=4)
+        msg.content = 'changed'
+        await msg.asave()
+        assert Message.objects.get(id=msg.id).content == 'changed'
+        await msg.adelete()
+        with pytest.raises(ModelNotFound):
+            await Message.objects.aget(id=msg.id)
+
+        new = Message(content='new')
+        await new.asave()
+        assert new.id is not None
+        with pytest.raises(MultipleObjectsReturned):
+            await Message.objects.aget(user_id=user.id)
+        assert Message.objects.stats()['in_use'] == 0
+        return Message.manager_class.async_pool.stats()
+
+    stats = asyncio.run(main())
+    assert stats['in_use'] == 0
+    assert 1 <= stats['size'] <= TEST_DB_SETTINGS.get('POOL_MAX_SIZE', 10)
+    # a later event loop gets fresh connections
+    assert asyncio.run(Message.objects.where(content='new').acount()) == 1
+
+
+def test_prepared_statements(test_client_db, cleanup):
+    Job, Message, User = test_client_db
+    assert to_prepared_sql("SELECT a FROM t WHERE a=%s AND b LIKE %s;") == ("SELECT a FROM t WHERE a=$1 AND b LIKE $2", 2)
+
+    cache = PreparedStatementCache(maxsize=2, threshold=2)
+    BaseManager.set_prepared_statements(cache)
+    try:
+        user = User.objects.create(email='a@example.com', first_name='a', last_name='b', is_active=True)
+        for i in range(4):
+            Message.objects.create(content=f"msg {i}", count=i, tries=1.5, user_id=user.id,
+                                   date_created=datetime.now(timezone.utc))
+        assert cache.info()['prepares'] >= 2
+        assert cache.info()['hits'] >= 2
+        assert [msg.count for msg in Message.objects.where(count__in=[1, 2]).order_by('count')] == [1, 2]
+        assert [msg.count for msg in Message.objects.where(count__in=[1, 2]).order_by('count')] == [1, 2]
+        assert Message.objects.where(content__in=['msg 3']).count() == 1
+        assert Message.objects.where(content__in=['msg 3']).count() == 1
+        assert Message.objects.where(count__in=[]).count() == 0
+        assert Message.objects.where(count__in=[]).count() == 0
+
+        msg = Message.objects.get(count=0)
+        msg.content = 'changed'
+        msg.save()
+        assert Message.objects.get(id=msg.id).content == 'changed'
+
+        info = cache.info()
+        assert info['evictions'] > 0
+        assert 0 < info['hit_rate'] < 1
+        assert all(len(registry.prepared) <= 2 for registry in cache._connections.values())
+
+        # a schema change makes every connection deallocate its statements
+        Job.objects.create_table()
+        assert cache.info()['invalidations'] == 1
+        assert Message.objects.get(id=msg.id).content == 'changed'
+        assert Message.objects.get(id=msg.id).content == 'changed'
+        with atomic():
+            assert Message.objects.get(id=msg.id).content == 'changed'
+
+        # statements prepared by earlier caches are still on the pooled connections
+        for _ in range(2):
+            replacement = PreparedStatementCache(maxsize=2, threshold=1)
+            BaseManager.set_prepared_statements(replacement)
+            assert Message.objects.get(id=msg.id).content == 'changed'
+            assert Message.objects.get(id=msg.id).content == 'changed'
+            assert replacement.info()['prepares'] == 1 and replacement.info()['hits'] == 1
+    finally:
+        BaseManager.set_prepared_statements(None)
+
+
+def test_result_cache(test_client_db, cleanup, monkeypatch):
+    Job, Message, User = test_client_db
+    cache = ResultCache(ttl=60, ttls={Job: 0})
+    BaseManager.set_result_cache(cache)
+    try:
+        user = User.objects.create(email='a@example.com', first_name='a', last_name='b', is_active=True)
+        Message.objects.create(content='one', count=1, user_id=user.id)
+        active = Message.objects.where(is_active=True)
+        assert [msg.content for msg in active] == ['one']
+        assert list(Message.objects.values_list('id', flat=True)) == list(Message.objects.values_list('id', flat=True))
+        assert cache.info()['hits'] == 1
+
+        def fail(*args, **kwargs):
+            raise AssertionError('cached read should not hit the database')
+
+        monkeypatch.setattr(BaseManager, '_connection', fail)
+        assert [msg.content for msg in Message.objects.where(is_active=True)] == ['one']
+        monkeypatch.undo()
+        assert Message.objects.where(is_active=True).count() == 1
+
+        # writes through the manager and the model invalidate the table
+        msg = Message.objects.create(content='two', count=2)
+        assert Message.objects.where(is_active=True).count() == 2
+        msg.is_active = False
+        msg.save()
+        assert Message.objects.where(is_active=True).count() == 1
+        assert Message.objects.where(is_active=True).count() == 1
+        msg.delete()
+        assert Message.objects.values_list('id', flat=True).count() == 1
+
+        # deleting a user sets message.user_id to NULL, joined and referencing tables are invalidated
+        assert [m.user.email for m in Message.objects.all().select_related('user')] == ['a@example.com']
+        assert Message.objects.where(user_id__isnull=True).count() == 0
+        user.delete()
+        assert [m.user for m in Message.objects.all().select_related('user')] == [None]
+        assert Message.objects.where(user_id__isnull=True).count() == 1
+
+        # atomic blocks bypass the cache and invalidate again on commit
+        with atomic():
+            Message.objects.create(content='three')
+            assert Message.objects.all().count() == 2
+        assert Message.objects.all().count() == 2
+
+        # ttl 0 disables caching for a model
+        Job.objects.create(data='job', is_active=True)
+        hits = cache.info()['hits']
+        assert Job.objects.all().count() == 1
+        assert Job.objects.all().count() == 1
+        assert cache.info()['hits'] == hits
+    finally:
+        BaseManager.set_result_cache(None)
+
+
+def test_local_cache_eviction():
+    backend = LocalCache(max_entries=2)
+    backend.set('a', [(1,)])
+    backend.set('b', [(2,)])
+    assert backend.get('a') == [(1,)]
+    backend.set('c', [(3,)])
+    assert backend.get('b') is None
+    assert backend.get('a') == [(1,)]
+    assert backend.info()['evictions'] == 1
+
+    backend.set('expired', [(1,)], ttl=0)
+    assert backend.get('expired') is None
+
+    small = LocalCache(max_bytes=1000)
+    small.set('big', [(i,) for i in range(100)])
+    assert small.get('big') is None
+    small.set('rows', [(1, 'a')])
+    small.set('more', [(2, 'b')])
+    assert small.info()['bytes'] <= 1000
+
+
+def test_to_columns(test_client_db, cleanup):
+    np = pytest.importorskip('numpy')
+    Job, Message, User = test_client_db
+    now = datetime(2022, 5, 1, 12, 30, 15, 250, tzinfo=timezone.utc)
+    Message.objects.bulk_create([
+        Message(content=f"msg {i}", count=i if i % 2 else None, tries=i * 1.5, is_active=bool(i % 3),
+                date_created=now + timedelta(days=i) if i != 2 else None)
+        for i in range(5)
+    ])
+
+    columns = Message.objects.all().order_by('id').to_columns(chunk_size=2)
+    assert set(columns) == set(Message._meta.all_columns)
+    assert columns['id'].dtype == np.int64 and not isinstance(columns['id'], np.ma.MaskedArray)
+    assert columns['is_active'].dtype == bool
+    assert list(columns['content']) == [f"msg {i}" for i in range(5)]
+
+    count = columns['count']
+    assert isinstance(count, np.ma.MaskedArray) and count.dtype == np.int64
+    assert list(count.mask) == [True, False, True, False, True]
+    assert count.sum() == 4
+    assert np.allclose(columns['tries'], [0, 1.5, 3, 4.5, 6])
+
+    dates = columns['date_created']
+    assert dates.dtype == np.dtype('datetime64[us]')
+    assert dates.mask[2]
+    assert dates[0] == np.datetime64('2022-05-01T12:30:15.000250')
+    assert dates[4] == np.datetime64('2022-05-05T12:30:15.000250')
+
+    selected = Message.objects.values_list('count', 'tries').where(count__gte=1).order_by('-count').to_columns()
+    assert list(selected) == ['count', 'tries']
+    assert list(selected['count']) == [3, 1]
+    assert list(selected['tries']) == [4.5, 1.5]
+
+    empty = Message.objects.values('count', 'date_created').where(count=99).to_columns()
+    assert len(empty['count']) == 0 and empty['date_created'].dtype == np.dtype('datetime64[us]')
+
+
+def test_export(test_client_db, cleanup, tmp_path):
+    Job, Message, User = test_client_db
+    Message.objects.bulk_create([
+        Message(content=f"msg {i}", body='quote " comma, back\\slash\nnew line', count=i,
+                date_created=datetime(2022, 5, 1, tzinfo=timezone.utc))
+        for i in range(3)
+    ])
+    Message.objects.create(content='100% done', count=None)
+    queryset = Message.objects.values('content', 'body', 'count').where(count__gte=1).order_by('-count')
+
+    path = tmp_path / 'messages.csv'
+    with open(path, 'w', newline='') as f:
+        assert queryset.export(f) == 2
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [
+        {'content': 'msg 2', 'body': 'quote " comma, back\\slash\nnew line', 'count': '2'},
+        {'content': 'msg 1', 'body': 'quote " comma, back\\slash\nnew line', 'count': '1'},
+    ]
+
+    buffer = io.BytesIO()
+    assert Message.objects.all().where(content__startswith='100%').export(buffer, format='ndjson') == 1
+    lines = buffer.getvalue().decode().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['content'] == '100% done'
+    assert json.loads(lines[0])['count'] is None
+
+    buffer = io.StringIO()
+    Message.objects.values('body', 'date_created').where(count=0).export(buffer, format='ndjson')
+    exported = json.loads(buffer.getvalue())
+    assert exported['body'] == 'quote " comma, back\\slash\nnew line'
+    assert exported['date_created'].startswith('2022-05-01')
+
+    buffer = io.StringIO()
+    Message.objects.values_list('count', flat=True).where(count=1).export(buffer, header=False)
+    assert buffer.getvalue() == '1\n'
+    with pytest.raises(ValueError):
+        queryset.export(io.StringIO(), format='xml')
+
+
+def test_aggregate_and_annotate(test_client_db, cleanup):
+    Job, Message, User = test_client_db
+    users = [
+        User.objects.create(email=f"{i}@example.com", first_name='a', last_name='b', is_active=True)
+        for i in range(3)
+    ]
+    Message.objects.bulk_create([
+        Message(content=f"msg {i}", count=i, tries=float(i), is_active=i != 4, user_id=users[i % 2].id)
+        for i in range(5)
+    ] + [Message(content='orphan', count=None, tries=None)])
+
+    result = Message.objects.where(is_active=True).aggregate(total=Sum('count'), avg=Avg('tries'), n=Count('id'))
+    assert result == {'total': 6, 'avg': 1.5, 'n': 5}
+    assert Message.objects.all().order_by('id')[:2].aggregate(total=Sum('count')) == {'total': 1}
+    assert Message.objects.where(count=99).aggregate(total=Sum('count'), n=Count('*')) == {'total': None, 'n': 0}
+    assert Message.objects.values('content').aggregate(top=Max('count')) == {'top': 4}
+
+    per_user = list(
+        Message.objects.values('user_id').where(user_id__isnull=False).annotate(n=Count('id'), total=Sum('count'))
+        .order_by('-n')
+    )
+    assert per_user == [
+        {'user_id': users[0].id, 'n': 3, 'total': 6},
+        {'user_id': users[1].id, 'n': 2, 'total': 4},
+    ]
+    grouped = Message.objects.values_list('user_id').annotate(n=Count('id')).where(n__gte=2).order_by('user_id')
+    assert list(grouped) == [(users[0].id, 3), (users[1].id, 2)]
+    assert grouped.count() == 2
+    assert grouped.exists()
+    assert grouped.aggregate(most=Max('n')) == {'most': 3}
+    assert list(Message.objects.values_list('user_id', flat=True).annotate(n=Count('id')).where(n=1)) == [None]
+
+    users_with_counts = User.objects.all().annotate(n=Count('email')).order_by('id')
+    assert [(user.email, user.n) for user in users_with_counts] == [(user.email, 1) for user in users]
+
+    # annotations and select_related compose in either order
+    expected = [(msg.content, msg.user_id, 1) for msg in Message.objects.all().order_by('id')]
+    for queryset in (
+        Message.objects.all().annotate(n=Count('id')).select_related('user'),
+        Message.objects.all().select_related('user').annotate(n=Count('id')),
+    ):
+        messages = list(queryset.order_by('id'))
+        assert [(msg.content, msg.user_id, msg.n) for msg in messages] == expected
+        assert [msg.user.email if msg.user else None for msg in messages] == [
+            User.objects.get(id=msg.user_id).email if msg.user_id else None for msg in messages
+        ]
+        assert 'LEFT JOIN users_user' in queryset.sql
+
+    np = pytest.importorskip('numpy')
+    columns = Message.objects.values('user_id').annotate(n=Count('id'), avg=Avg('tries')).order_by('user_id') \
+        .to_columns()
+    assert columns['n'].dtype == np.int64 and list(columns['n']) == [3, 2, 1]
+    assert columns['avg'].mask.tolist() == [False, False, True]
+
+    Message.objects.bulk_create([
+        Message(content='dated', date_created=datetime(2022, 5, day, tzinfo=timezone.utc)) for day in (2, 1, 2)
+    ])
+    per_day = Message.objects.values('date_created').where(date_created__isnull=False).annotate(n=Count('id')) \
+        .order_by('-date_created').to_columns()
+    assert per_day['date_created'].tolist() == [datetime(2022, 5, 2), datetime(2022, 5, 1)]
+    assert per_day['n'].tolist() == [2, 1]
+
+
+def test_indexes(test_client_db, cleanup, test_db_connection):
+    Job, Message, User = test_client_db
+
+    def index_definitions(table_name):
+        cursor = test_db_connection.cursor()
+        cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s;", (table_name,))
+        rows = dict(cursor.fetchall())
+        test_db_connection.commit()
+        return rows
+
+    messages = index_definitions('messages_message')
+    assert 'messages_message_user_id_idx' in messages
+    assert messages['messages_message_user_id_date_created_idx'].endswith('(user_id, date_created DESC)')
+    assert 'users_user_email_idx' in index_definitions('users_user')
+    assert not any('jobs_job' in name and 'pkey' not in name for name in index_definitions('jobs_job'))
+
+    cursor = test_db_connection.cursor()
+    cursor.execute("DROP INDEX users_user_email_idx;")
+    test_db_connection.commit()
+    statements = User.objects.create_indexes()
+    assert statements == ['CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_email_idx ON users_user (email);']
+    assert 'users_user_email_idx' in index_definitions('users_user')
+    assert User.objects.stats()['in_use'] == 0
+    with pytest.raises(ValueError):
+        with atomic():
+            User.objects.create_indexes()
+
+    class Tag(Model):
+        name = fields.CharField(max_length=50, unique=True)
+        category = fields.CharField(max_length=50)
+        is_active = fields.BooleanField(default=True)
+
+        class Meta:
+            indexes = [Index('category', where='is_active', name='active_tag_category')]
+
+    assert not hasattr(Tag, 'Meta')
+    try:
+        Tag.objects.create_table()
+        tags = index_definitions('tags_tag')
+        assert 'UNIQUE' in tags['tags_tag_name_uniq']
+        assert tags['active_tag_category'].endswith('WHERE is_active')
+        Tag.objects.create(name='a', category='c')
+        with pytest.raises(psycopg2.errors.UniqueViolation):
+            Tag.objects.create(name='a', category='c')
+        Tag.objects.create_indexes(concurrently=False)
+    finally:
+        cursor.execute("DROP TABLE IF EXISTS tags_tag;")
+        test_db_connection.commit()
+
+    with pytest.raises(ValueError):
+        class Broken(Model):
+            name = fields.CharField()
+
+            class Meta:
+                indexes = [Index('missing')]
+
+    long_name = Index('a' * 40, 'b' * 40).get_name('table')
+    assert len(long_name) <= 63 and long_name.endswith('_idx')
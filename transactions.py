@@ -0,0 +1,77 @@
+import contextvars
+
+
+_current_transaction = contextvars.ContextVar('orm_transaction', default=None)
+
+
+def current_transaction():
+    """ the Transaction of the outermost atomic block in this thread / task, or None """
+    return _current_transaction.get()
+
+
+class Transaction():
+    """ connection pinned to an atomic block plus its open savepoints """
+
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+        self.savepoints = []
+        self.written_tables = set()
+        self._savepoint_id = 0
+
+    def next_savepoint_name(self):
+        self._savepoint_id += 1
+        return f"orm_savepoint_{self._savepoint_id}"
+
+
+class Atomic():
+    """
+    Transaction block. The outermost block borrows a connection that every manager,
+    queryset and model method in the block uses; it commits once on success and rolls
+    back on exception. Nested blocks use savepoints, so an inner failure only undoes
+    the inner block
+    """
+
+    def __init__(self, manager_class):
+        self.manager_class = manager_class
+        self._stack = []
+
+    def __enter__(self):
+        transaction = current_transaction()
+        if transaction is None:
+            pool = self.manager_class.pool
+            transaction = Transaction(pool, pool.getconn())
+            token = _current_transaction.set(transaction)
+            self._stack.append((transaction, token, None))
+        else:
+            savepoint = transaction.next_savepoint_name()
+            transaction.connection.cursor().execute(f"SAVEPOINT {savepoint};")
+            transaction.savepoints.append(savepoint)
+            self._stack.append((transaction, None, savepoint))
+        return transaction
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        transaction, token, savepoint = self._stack.pop()
+        connection = transaction.connection
+
+        if savepoint is not None:
+            transaction.savepoints.pop()
+            if connection.closed:
+                return False
+            if exc_type is None:
+                connection.cursor().execute(f"RELEASE SAVEPOINT {savepoint};")
+            else:
+                connection.cursor().execute(f"ROLLBACK TO SAVEPOINT {savepoint};")
+            return False
+
+        try:
+            if exc_type is None:
+                connection.commit()
+            elif not connection.closed:
+                connection.rollback()
+        finally:
+            _current_transaction.reset(token)
+            transaction.pool.putconn(connection)
+            # results cached while the block was open may predate its commit
+            self.manager_class._invalidate_tables(transaction.written_tables)
+        return False